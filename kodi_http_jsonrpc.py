@@ -48,19 +48,64 @@
                 xbmcgui.Dialog().notification(addon.getAddonInfo('name'), response['error'], icon_path, time=7000, sound=False)
             else:
                 xbmcgui.Dialog().notification(addon.getAddonInfo('name'), 'Request Successful', icon_path, time=7000, sound=False)
+
+    requests to the same host reuse persistent HTTP/1.1 keep-alive connections from CONNECTION_POOL,
+    a burst of requests costs one connection setup. CONNECTION_POOL.clear() closes the idle connections
 """
 
 import json
 import base64
-import urllib2
+import errno
+import httplib
 import socket
+import threading
 import xbmc
 import xbmcaddon
 
 
+class ConnectionPool:
+    """
+    Idle keep-alive connections per host and port, shared by the HttpJSONRPC clients
+    """
+
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def acquire(self, host, port):
+        """
+        :return: tuple: (httplib.HTTPConnection, True if it is an idle connection being reused)
+        """
+        with self.lock:
+            connections = self.idle.get((host, port))
+            if connections:
+                return connections.pop(), True
+        return httplib.HTTPConnection(host, port), False
+
+    def release(self, host, port, connection):
+        with self.lock:
+            connections = self.idle.setdefault((host, port), [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
 class HttpJSONRPC:
-    def __init__(self, ip_address=None, port=None, username=None, password=None):
+    def __init__(self, ip_address=None, port=None, username=None, password=None, pool=CONNECTION_POOL):
         __addon = xbmcaddon.Addon()
+        self.pool = pool
         self.ip_address = __addon.getSetting('remote-ip') if ip_address is None else ip_address
         self.port = __addon.getSetting('remote-port') if port is None else port
         self.username = __addon.getSetting('remote-username').strip() if username is None else username
@@ -69,7 +114,7 @@ class HttpJSONRPC:
         self.url = 'http://%s:%s/jsonrpc' % (self.ip_address, self.port) if self.has_connection_details else None
         self.authorization = base64.b64encode(self.username + b':' + self.password) if self.has_connection_details else None
         self.headers = {'User-Agent': '%s/%s' % (__addon.getAddonInfo('name'), __addon.getAddonInfo('version')),
-                        'Content-Type': 'application/json'}
+                        'Content-Type': 'application/json', 'Connection': 'keep-alive'}
         if self.authorization:
             self.headers.update({'Authorization': b'Basic ' + self.authorization})
 
@@ -91,34 +136,70 @@ class HttpJSONRPC:
             return {'error': self.connection_details_error}
         xbmc.log('JSON-RPC request |%s|' % command, xbmc.LOGDEBUG)
         null_response = None
+        contents = None
         data = json.dumps(command)
-        request = urllib2.Request(self.url, headers=self.headers, data=data)
-        method = 'POST'
-        request.get_method = lambda: method
         try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as e:
-            error = 'JSON-RPC received HTTPError |[Code %s] %s|' % (e.code, e.msg)
-            xbmc.log(error, xbmc.LOGINFO)
-            return {'error': 'HTTPError |[Code %s] %s|' % (e.code, e.msg)}
-        except urllib2.URLError as e:
-            error = 'JSON-RPC received URLError |%s|' % e.args
-            xbmc.log(error, xbmc.LOGINFO)
-            return {'error': 'URLError |%s|' % e.args}
+            status, reason, contents = self._post(data)
         except socket.timeout as e:
-            response = None
             null_response = {'result': 'No response/Timed out'}  # some requests do not respond timely. (ie. Player.Open + picture)
+        except (httplib.HTTPException, socket.error) as e:
+            error = 'JSON-RPC received URLError |%s|' % (e.args,)
+            xbmc.log(error, xbmc.LOGINFO)
+            return {'error': 'URLError |%s|' % (e.args,)}
+        else:
+            if status >= 400:
+                error = 'JSON-RPC received HTTPError |[Code %s] %s|' % (status, reason)
+                xbmc.log(error, xbmc.LOGINFO)
+                return {'error': 'HTTPError |[Code %s] %s|' % (status, reason)}
 
-        if not null_response and response:
-            contents = response.read()
+        if not null_response and contents:
             xbmc.log('JSON-RPC response |%s|' % contents, xbmc.LOGDEBUG)
             json_response = json.loads(contents)
-            response.close()
         else:
-            json_response = null_response
+            json_response = null_response or {}
             xbmc.log('JSON-RPC response |%s|' % null_response, xbmc.LOGDEBUG)
         return self._eval_response(json_response)
 
+    def _post(self, data):
+        """
+        POSTs data on a keep-alive connection from the pool, the connection is returned to the pool
+        once the response is read unless the host closes it.
+        The request is only sent again if a reused connection was closed before any of the response arrived,
+        JSON-RPC methods like Player.Open must not run twice
+        :return: tuple: (status, reason, contents)
+        """
+        while True:
+            connection, reused = self.pool.acquire(self.ip_address, self.port)
+            sending = True
+            try:
+                connection.request('POST', '/jsonrpc', data, self.headers)
+                sending = False
+                response = connection.getresponse()
+                contents = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                if reused and self._closed_before_response(e, sending):
+                    # the host closed the idle connection, reconnect and send the request again
+                    xbmc.log('JSON-RPC reconnecting to |%s:%s| after |%s|' % (self.ip_address, self.port, e), xbmc.LOGDEBUG)
+                    continue
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self.pool.release(self.ip_address, self.port, connection)
+            return response.status, response.reason, contents
+
+    @staticmethod
+    def _closed_before_response(error, sending):
+        """
+        :return: bool: True if error shows the host had closed the connection, the request was refused
+        while it was sent or the connection ended without a status line
+        """
+        if sending:
+            return getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+        return isinstance(error, httplib.BadStatusLine)
+
     @staticmethod
     def _eval_response(response):
         if 'error' in response:
@@ -18,24 +18,83 @@ To enable the auto-compressor, set the compress_addons setting to True
 If you do this you must make sure the 'datadir zip' parameter in the addon.xml
 of your repository file is set to 'true'.
 
+To compress add-ons in parallel, set the workers setting to the number of
+processes to use, 0 will use one process per available cpu core.
+
+Run with --watch to keep the repository up to date while editing, only the
+changed add-ons are compressed and only their entries in addons.xml are replaced.
+
+To build several repositories from the same sources, for example one for Leia and
+one for Matrix, add their settings to the targets setting. Each target overrides
+the top level settings it names (name, path, matrix_build_version, compress_only,
+tag_unofficial_releases, checksums, index_compression, retention and
+build_manifest) and all of them are built in a single pass, every add-on is read
+and hashed once and the compressed files are shared by the targets.
+
+Old releases are kept unless retention is set, keep_versions keeps that many of the
+newest releases of each add-on and keep_newer_than (YYYY-MM-DD) keeps the releases
+built since that date, older zips and their changelogs are removed during the build.
+Each release folder has a .releases.json index of its zips, run with --force to
+rebuild the indexes after changing the release folders by hand.
+
+Kodi downloads addons.xml on every repository refresh, index_compression lists the
+compressed copies written next to it (gz, bz2 and on Python 3 xz) so they can be
+served instead. Each copy has its own checksum files.
+
+Run with --verify to check the built repository instead of building it: the CRC of
+every file in every zip, the addon.xml in each zip against the zip's name and
+addons.xml, ignored files in the zips and the checksum files. The exit status is
+non-zero if anything doesn't match.
+
+Run with --profile to print the time and bytes spent on each add-on and build phase,
+--profile-output writes the profile as JSON (*.json) or a cProfile dump (other names).
+
 Please bump __revision__ one decimal point and add your name to credits when making changes
 """
 
 from lxml import etree
+import argparse
+import bz2
+import collections
+import cProfile
+import ctypes
+import ctypes.util
 import hashlib
 import json
+import math
+import multiprocessing
 import os
 import re
+import select
 import shutil
+import struct
 import sys
+import time
 import zipfile
+import zlib
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
 
 __script__ = '.repo_prep.py'
-__revision__ = '6.0b'
+__revision__ = '7.2b'
 __homepage__ = 'https://forum.kodi.tv/showthread.php?tid=129401'
 __credits__ = 'Unobtanium, anxdpanic'
 __license__ = 'GPL-3.0-only'
 
+TIMER = getattr(time, 'perf_counter', time.time)
+
+# incremental compressors of the compressed copies of addons.xml, keyed by extension.
+# gzip output has no file name or timestamp so unchanged contents give identical files
+INDEX_COMPRESSORS = {
+    'gz': lambda: zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+    'bz2': lambda: bz2.BZ2Compressor(9),
+}
+if lzma:
+    INDEX_COMPRESSORS['xz'] = lzma.LZMACompressor
+
 
 class Generator:
     """
@@ -44,179 +103,480 @@ class Generator:
         the checked-out repo. Only handles single depth folder structure.
     """
 
-    def __init__(self):
+    def __init__(self, target=None, released=None, auto_run=True):
+        # the build target whose repository is generated, defaults to the first
+        self.target = target or TARGETS[0]
+        self.zips_path = self.target.zips_path
 
         # paths
-        self.addons_xml = os.path.join(REPOSITORY_PATH, 'addons.xml')
-        self.addons_xml_md5 = os.path.join(REPOSITORY_PATH, 'addons.xml.md5')
+        self.addons_xml = os.path.join(self.target.repository_path, 'addons.xml')
+        self.compressed_files = [self.addons_xml + '.' + extension
+                                 for extension in self.target.index_compression]
+        self.checksum_files = [filename + '.' + algorithm
+                               for filename in [self.addons_xml] + self.compressed_files
+                               for algorithm in self.target.checksums]
+
+        self.manifest = self.target.manifest
+        # metadata of add-ons released by Compressor in this run, keyed by add-on
+        self.released = released or {}
+        # cleaned addon.xml of every add-on, only kept in memory by watch mode
+        self.entries = None
 
         # call master function
-        self.generate_addons_files()
+        if auto_run:
+            self.generate_addons_files()
 
-    def generate_addons_files(self):
+    def _list_addons(self):
         # addon list
-        addons = os.listdir(ZIPS_PATH)
-        # final addons text
-        addons_xml = u'<?xml version=\'1.0\' encoding=\'UTF-8\' standalone=\'yes\'?>\n<addons>\n'
+        addons = []
+        with profile_phase('list'):
+            for addon in os.listdir(self.zips_path):
+                if addon in IGNORED_ADDONS:
+                    continue
+                # skip any file or .svn folder
+                if is_addon_dir(os.path.join(self.zips_path, addon)):
+                    addons.append(addon)
+        return addons
+
+    def generate_addons_files(self):
+        addons = self._list_addons()
 
         found_an_addon = False
-        path = ''
+        changed = False
+        signatures = {}
 
-        # loop through and add each addons addon.xml file
+        # compare each addon.xml with the build manifest before reading any of them
         for addon in addons:
-            if addon in IGNORED_ADDONS:
+            path = os.path.join(self.zips_path, addon, 'addon.xml')
+            if not os.path.exists(path):
                 continue
-            try:
-                addon = os.path.join(ZIPS_PATH, addon)
-                # skip any file or .svn folder
-                if is_addon_dir(addon):
-
-                    # create path
-                    path = os.path.join(addon, 'addon.xml')
+            found_an_addon = True
+            stat = os.stat(path)
+            signatures[addon] = [stat.st_size, repr(stat.st_mtime)]
+            if self.manifest:
+                entry = self.manifest.get('generator', addon)
+                if not entry or entry['signature'] != signatures[addon]:
+                    changed = True
+                    self.manifest.set('generator', addon, {'signature': signatures[addon]})
+
+        if self.manifest and self.manifest.prune('generator', signatures):
+            changed = True
 
-                    if os.path.exists(path):
-                        found_an_addon = True
+        # only generate files if we found an addon.xml
+        if not found_an_addon:
+            print('Could not find any addons, so script has done nothing.')
+            return
 
-                    # split lines for stripping
-                    xml_lines = read_file(path)
-                    xml_lines = xml_lines.splitlines()
+        if (self.manifest and not changed and not FORCE_REBUILD and
+                all(os.path.exists(filename) for filename in
+                    [self.addons_xml] + self.compressed_files + self.checksum_files)):
+            print(' ')
+            print('addons.xml and checksum files are up to date')
+            return
 
-                    # new addon
-                    addon_xml = ''
+        try:
+            self._write_addons_xml(self._read_entries(addons))
+        except (IOError, OSError) as error:
+            # oops
+            print('An error occurred saving %s file!\n%s' % (self.addons_xml, error))
+            return
 
-                    # loop through cleaning each line
-                    for line in xml_lines:
-                        if isinstance(line, bytes):
-                            line.decode('utf-8')
-                        # skip encoding format line
-                        if line.find('<?xml') >= 0:
-                            continue
-                        # add line
-                        addon_xml += line.rstrip() + '\n'
+        # notify user
+        print(' ')
+        print('Updated addons xml and %s files' %
+              ', '.join(os.path.basename(filename)
+                        for filename in self.compressed_files + self.checksum_files))
+
+    def load_entries(self):
+        # read the cleaned addon.xml of every add-on once, used to patch addons.xml
+        self.entries = collections.OrderedDict()
+        for addon in self._list_addons():
+            addon_xml = self._read_entry(addon)
+            if addon_xml is not None:
+                self.entries[addon] = addon_xml
+
+    def update_addon(self, addon, metadata=None):
+        # replace a single add-on's entry and rewrite addons.xml and its checksum files
+        if self.entries is None:
+            self.load_entries()
+
+        if metadata:
+            self.released[addon] = metadata
+        addon_xml = self._read_entry(addon)
+        if addon_xml is None:
+            return False
+        self.entries[addon] = addon_xml
+
+        path = os.path.join(self.zips_path, addon, 'addon.xml')
+        if self.manifest and os.path.exists(path):
+            stat = os.stat(path)
+            self.manifest.set('generator', addon, {'signature': [stat.st_size,
+                                                                 repr(stat.st_mtime)]})
 
-                    # we succeeded so add to our final addons.xml text
-                    addons_xml += addon_xml.rstrip() + '\n\n'
+        try:
+            self._write_addons_xml(self.entries.values())
+        except (IOError, OSError) as error:
+            # oops
+            print('An error occurred saving %s file!\n%s' % (self.addons_xml, error))
+            return False
+        return True
 
-            except Exception as error:  # pylint: disable=broad-except
-                # missing or poorly formatted addon.xml
-                print('Excluding %s for %s' % (path, error))
+    def _read_entries(self, addons):
+        # yield the cleaned addon.xml of each add-on, reading them one at a time
+        for addon in addons:
+            addon_xml = self._read_entry(addon)
+            if addon_xml is not None:
+                yield addon_xml
 
-        # clean and add closing tag
-        addons_xml = addons_xml.strip() + u'\n</addons>\n'
+    def _read_entry(self, addon):
+        # create path
+        path = os.path.join(self.zips_path, addon, 'addon.xml')
+        try:
+            with profile_phase('assemble', addon) as phase:
+                if addon in self.released:
+                    addon_xml = self.released[addon].get_release_addon_xml()
+                else:
+                    addon_xml = read_file(path)
+                phase.add_bytes(len(addon_xml))
+                return self._clean_addon_xml(addon_xml)
+        except Exception as error:  # pylint: disable=broad-except
+            # missing or poorly formatted addon.xml
+            print('Excluding %s for %s' % (path, error))
+            return None
+
+    def _write_addons_xml(self, entries):
+        # stream each cleaned addon.xml into a temporary file and its compressed copies,
+        # hashing them as they are written, then move them and their checksum files into place
+        with ChecksumFileWriter(self.addons_xml, self.target.checksums,
+                                self.target.index_compression) as addons_xml, \
+                profile_phase('assemble', os.path.basename(self.addons_xml)):
+            addons_xml.write(u'<?xml version=\'1.0\' encoding=\'UTF-8\' standalone=\'yes\'?>\n'
+                             u'<addons>\n')
+
+            separator = u''
+            # loop through and add each addons addon.xml file
+            for addon_xml in entries:
+                addons_xml.write(separator + addon_xml)
+                separator = u'\n\n'
+
+            # add closing tag
+            addons_xml.write(u'\n</addons>\n' if separator else u'</addons>\n')
+
+            addons_xml.commit()
+
+    @staticmethod
+    def _clean_addon_xml(addon_xml):
+        # split lines for stripping
+        xml_lines = addon_xml.splitlines()
+
+        # new addon
+        addon_xml = []
+
+        # loop through cleaning each line
+        for line in xml_lines:
+            # skip encoding format line
+            if line.find('<?xml') >= 0:
+                continue
+            # add line
+            addon_xml.append(line.rstrip())
 
-        # only generate files if we found an addon.xml
-        if found_an_addon:
-            # save files
-            save_file(self.addons_xml, addons_xml.encode('UTF-8'))
-            self.generate_md5_file()
+        return u'\n'.join(addon_xml).rstrip()
 
-            # notify user
-            print(' ')
-            print('Updated addons xml and addons.xml.md5 files')
-        else:
-            print('Could not find any addons, so script has done nothing.')
 
-    def generate_md5_file(self):
-        try:
-            # create a new md5 hash
-            contents = read_file(self.addons_xml)
-            md5 = hashlib.md5(contents.encode('utf-8')).hexdigest()
-            # save file
-            save_file(self.addons_xml_md5, md5)
+class ChecksumFileWriter:
+    """
+        Writes a file through a temporary file in the same folder, hashing the
+        contents as they are written. commit() renames the file and a checksum
+        file for each algorithm into place, the temporary files are removed if
+        the writer is closed without committing.
+        Each extension in compressions also streams a compressed copy of the
+        contents to filename.extension, with checksum files of its own.
+    """
 
-        except Exception as error:  # pylint: disable=broad-except
-            # oops
-            print('An error occurred creating addons.xml.md5 file!\n%s' % error)
+    def __init__(self, filename, algorithms=('md5',), compressions=()):
+        self.filename = filename
+        self.hashes = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+        self.temp_filenames = []
+        self.open_file = self._open_temp_file(filename)
+        self.compressed = [(INDEX_COMPRESSORS[extension](),
+                            ChecksumFileWriter(filename + '.' + extension, algorithms))
+                           for extension in compressions]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _open_temp_file(self, filename):
+        temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        self.temp_filenames.append(temp_filename)
+        return open(temp_filename, 'wb')
+
+    def write(self, contents):
+        if not isinstance(contents, bytes):
+            contents = contents.encode('utf-8')
+        self.open_file.write(contents)
+        with profile_phase('checksum', os.path.basename(self.filename)) as phase:
+            for _, checksum in self.hashes:
+                checksum.update(contents)
+            phase.add_bytes(len(contents))
+        for compressor, writer in self.compressed:
+            writer.write(compressor.compress(contents))
+
+    def hexdigest(self, algorithm):
+        return dict(self.hashes)[algorithm].hexdigest()
+
+    def commit(self):
+        for compressor, writer in self.compressed:
+            writer.write(compressor.flush())
+            writer.commit()
+
+        self.open_file.close()
+        moves = [(self.temp_filenames[0], self.filename)]
+        for algorithm, checksum in self.hashes:
+            checksum_file = self._open_temp_file(self.filename + '.' + algorithm)
+            with checksum_file:
+                checksum_file.write(checksum.hexdigest().encode('utf-8'))
+            moves.append((self.temp_filenames[-1], self.filename + '.' + algorithm))
+
+        for source, destination in moves:
+            replace_file(source, destination)
+        self.temp_filenames = []
+
+    def close(self):
+        for _, writer in self.compressed:
+            writer.close()
+        if not self.open_file.closed:
+            self.open_file.close()
+        for temp_filename in self.temp_filenames:
+            try:
+                os.remove(temp_filename)
+            except OSError:
+                pass
+        self.temp_filenames = []
 
 
 class Compressor:
-    def __init__(self):
+    def __init__(self, auto_run=True):
         # variables used later on
         self.addon_name = None
         self.addon_path = None
         self.addon_folder_contents = None
-        self.xml_file = None
-        self.addon_xml = None
-        self.addon_version_number = None
+        self.source_metadata = None
+        self.tree_files = None
+        self.tree_hash = None
+        self.target = None
+        self.metadata = None
         self.addon_zip_path = None
         self.addon_path_zips = None
+        self.release_indexes = {}
+
+        # metadata of the add-ons whose addon.xml was released in this run,
+        # keyed by build target name and add-on
+        self.released = dict((target.name, {}) for target in TARGETS)
 
         # run the master method of the class, when class is initialised.
         # only do so if we want addons compressed.
-        if COMPRESS_ADDONS:
+        if auto_run and COMPRESS_ADDONS:
             self.compress_addons()
 
     def compress_addons(self):
-        source_directory = os.listdir(SOURCE_PATH)
-        for addon in source_directory:
-            if addon in IGNORED_ADDONS:
+        addons = list_source_addons()
+
+        workers = min(get_worker_count(), len(addons))
+        if workers > 1:
+            # add-ons are independent of each other, compress them on a process pool.
+            # the pool initializer loads the configuration in each worker so this
+            # also works where processes are spawned instead of forked
+            pool = multiprocessing.Pool(processes=workers, initializer=load_config,
+                                        initargs=(CONFIG,))
+            try:
+                results = pool.map(_compress_addon_worker,
+                                   [(addon, self._get_manifest_entries(addon))
+                                    for addon in addons],
+                                   chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [(addon,) + self.compress_addon(addon, self._get_manifest_entries(addon)) +
+                       (None,) for addon in addons]
+
+        for addon, _, _, released, profile in results:
+            for target_name, metadata in released.items():
+                self.released[target_name][addon] = metadata
+            if profile:
+                PROFILE.merge(profile)
+
+        for target in TARGETS:
+            if not target.manifest:
                 continue
-            # set variables
-            self.addon_name = str(addon)
-            self.addon_path = os.path.join(SOURCE_PATH, addon)
-            self.addon_path_zips = os.path.join(ZIPS_PATH, addon)
-            # skip any file or .svn folder.
-            if is_addon_dir(self.addon_path):
-                # set another variable
-                self.addon_folder_contents = os.listdir(self.addon_path)
-
-                # check if addon has a current zipped release in it.
-                addon_zip_exists = self._get_zipped_addon_path()
-
-                # checking for addon.xml and try reading it.
-                addon_xml_exists = self._read_addon_xml()
-                if addon_xml_exists:
-                    # now addon.xml has been read, scrape version number from it.
-                    # we need this when naming the zip (and if it exists the changelog)
-                    self._read_version_number()
-
-                    if not addon_zip_exists:
-                        addon_zip_exists = self._get_zipped_addon_path()
-                        if not addon_zip_exists:
-                            tags = ''
-                            if not MATRIX_BUILD_VERSION and is_py3(self.addon_xml):
-                                tags += 'python3-'
-                            if is_unofficial(self.xml_file):
-                                tags += 'unofficial-'
-
-                            print('Create compressed %s%s release for [%s] v%s' %
-                                  (tags, self._get_release_type(), self.addon_name,
-                                   self.addon_version_number))
-                            self.create_compressed_addon_release()
-
-    def _get_zip_name(self):
-        zip_name = self.addon_name
+            built = []
+            for addon, _, entries, _, _ in results:
+                if target.name in entries:
+                    target.manifest.set('compressor', addon, entries[target.name])
+                    built.append(addon)
+            target.manifest.prune('compressor', built)
+
+        failures = [(addon, error) for addon, error, _, _, _ in results if error]
+        for addon, error in failures:
+            print('Failed to compress [%s]: %s' % (addon, error))
+        if failures:
+            print('%d of %d add-ons failed to compress' % (len(failures), len(addons)))
+
+    @staticmethod
+    def _get_manifest_entries(addon):
+        entries = {}
+        for target in TARGETS:
+            if target.manifest:
+                entry = target.manifest.get('compressor', addon)
+                if entry:
+                    entries[target.name] = entry
+        return entries
+
+    def compress_addon(self, addon, entries=None):
+        # compress a single add-on for every build target, returns an error message on
+        # failure, the add-on's build manifest entries and the metadata of the targets
+        # its addon.xml was released to, both keyed by build target name
+        try:
+            entries = self._compress_addon(addon, entries or {})
+            self._update_release_indexes(entries)
+            return None, entries, self.released_metadata
+        except Exception as error:  # pylint: disable=broad-except
+            return '%s: %s' % (error.__class__.__name__, error), {}, {}
+
+    def _compress_addon(self, addon, entries):
+        # set variables
+        self.addon_name = str(addon)
+        self.addon_path = os.path.join(SOURCE_PATH, addon)
+        self.source_metadata = None
+        self.tree_hash = None
+        self.released_metadata = {}
+        self.release_indexes = {}
+
+        # compare the add-on source with its entries in the build manifests,
+        # unchanged add-ons with a zipped release are skipped without reading their addon.xml
+        with profile_phase('list', addon):
+            stat_hash, mtime, self.tree_files = get_tree_stats(self.addon_path)
+        results = {}
+        pending = []
+        for target in TARGETS:
+            entry = entries.get(target.name)
+            rebuild = FORCE_REBUILD
+            if entry and not rebuild:
+                zip_path = os.path.join(target.zips_path, addon, entry['metadata']['zip_name'])
+                if os.path.exists(zip_path):
+                    if entry['stat_hash'] == stat_hash:
+                        results[target.name] = entry
+                        continue
+                    # files were touched, only rebuild if their contents changed
+                    if entry['tree_hash'] == self._get_tree_hash():
+                        entry.update(stat_hash=stat_hash, mtime=mtime)
+                        results[target.name] = entry
+                        continue
+                rebuild = True
+            pending.append((target, rebuild))
 
-        if TAG_UNOFFICIAL_RELEASES and is_unofficial(self.xml_file):
-            zip_name += '-unofficial'
+        if not pending:
+            return results
 
-        zip_name += '-' + self.addon_version_number + '.zip'
+        # set another variable
+        with profile_phase('list', addon):
+            self.addon_folder_contents = os.listdir(self.addon_path)
 
-        return zip_name
+        # checking for addon.xml and try reading it, the version number scraped from it
+        # is needed when naming the zip (and if it exists the changelog)
+        addon_xml_exists = self._read_addon_xml()
+        if not addon_xml_exists:
+            return results
+
+        releases = []
+        for target, rebuild in pending:
+            self._set_target(target)
+
+            # check if addon has a current zipped release in it.
+            addon_zip_exists = self._get_zipped_addon_path()
+            if not addon_zip_exists or rebuild:
+                tags = ''
+                if not target.matrix_build_version and self.metadata.python3:
+                    tags += 'python3-'
+                if self.metadata.unofficial:
+                    tags += 'unofficial-'
+
+                print('Create compressed %s%s release for [%s] v%s%s' %
+                      (tags, self.metadata.get_release_type(), self.addon_name,
+                       self.metadata.version, (' (%s)' % target.name) if target.name else ''))
+                releases.append((target, self.metadata))
+
+            results[target.name] = {
+                'stat_hash': stat_hash,
+                'tree_hash': self._get_tree_hash(),
+                'mtime': mtime,
+                'metadata': {
+                    'version': self.metadata.version,
+                    'zip_name': self.metadata.get_zip_name(),
+                    'python3': self.metadata.python3,
+                    'unofficial': self.metadata.unofficial,
+                },
+            }
+
+        if releases:
+            self.create_compressed_addon_releases(releases)
+
+        return results
+
+    def _get_tree_hash(self):
+        # content hash of the add-on source, shared by every build target
+        if self.tree_hash is None:
+            self.tree_hash = get_tree_hash(self.addon_path, self.tree_files)
+        return self.tree_hash
+
+    def _set_target(self, target, metadata=None):
+        self.target = target
+        self.addon_path_zips = os.path.join(target.zips_path, self.addon_name)
+        if metadata is None:
+            with profile_phase('parse', self.addon_name):
+                metadata = self.source_metadata.for_target(target)
+        self.metadata = metadata
 
     def _get_zipped_addon_path(self):
         # get name of addon zip file. returns False if not found.
-        addon_xml_exists = self._read_addon_xml()
-        if addon_xml_exists:
-            self._read_version_number()
-
-        zip_name = self._get_zip_name()
+        zip_name = self.metadata.get_zip_name()
 
         if not os.path.exists(self.addon_path_zips):
             if not self.addon_path_zips.endswith('zips'):
                 make_path = self.addon_path_zips
                 os.makedirs(make_path)
 
-        folder_contents = os.listdir(self.addon_path_zips)
-
-        for potential_zip in folder_contents:
-            if zip_name == potential_zip:
-                self.addon_zip_path = os.path.join(self.addon_path_zips, zip_name)
-                return True
-        # if loop is not broken by returning the addon path, zip was not found so return False
+        # the release index knows the zips in the folder without listing it
+        if self._get_release_index(self.addon_path_zips).has(zip_name):
+            self.addon_zip_path = os.path.join(self.addon_path_zips, zip_name)
+            return True
+        # zip was not found so return False
         self.addon_zip_path = None
         return False
 
+    def _get_release_index(self, path):
+        if path not in self.release_indexes:
+            self.release_indexes[path] = ReleaseIndex(path)
+        return self.release_indexes[path]
+
+    def _update_release_indexes(self, entries):
+        # remove the releases of each target outside its retention policy,
+        # then save the release indexes that changed
+        for target in TARGETS:
+            if not target.retention.enabled or target.name not in entries:
+                continue
+            path = os.path.join(target.zips_path, self.addon_name)
+            current = entries[target.name]['metadata']['zip_name']
+            for zip_name in self._get_release_index(path).prune(target.retention, current):
+                print('Removed old release %s%s' %
+                      (zip_name, (' (%s)' % target.name) if target.name else ''))
+
+        for release_index in self.release_indexes.values():
+            release_index.save()
+
     def _extract_addon_xml_to_release_folder(self):
         with zipfile.ZipFile(self.addon_path_zips, 'r') as zip_file:
             for filename in zip_file.namelist():
@@ -224,95 +584,138 @@ class Compressor:
                     zip_file.extract(filename, self.addon_path_zips)
                     break
 
-    def recursive_zipper(self, directory, zip_file):
+    def recursive_zipper(self, directory, zip_file, include_addon_xml=True):
         # initialize zipping module
-        ignored_files = IGNORED_FILES
-        if is_py3(self.addon_xml):
-            ignored_files.append('changelog.txt')
+        ignored_files = ['changelog.txt'] if self.metadata.python3 else []
 
-        with zipfile.ZipFile(zip_file, 'w', compression=zipfile.ZIP_DEFLATED) as zipped_file:
+        with zipfile.ZipFile(zip_file, 'w', compression=zipfile.ZIP_DEFLATED) as zipped_file, \
+                profile_phase('zip', self.addon_name) as phase:
             # get length of characters of what we will use as the root path
             root_len = len(os.path.dirname(os.path.abspath(directory)))
 
-            # recursive writer
-            for root, _, files in os.walk(directory):
+            # recursive writer, ignored directories and files are never listed
+            for root, _, files in IGNORE_MATCHER.walk(directory, ignored_files):
                 # subtract the source file's root from the archive root -
                 # ie. make /Users/me/desktop/zip_me.txt into just /zip_me.txt
                 archive_root = os.path.abspath(root)[root_len:]
 
                 for repo_file in files:
 
-                    if repo_file.endswith(IGNORED_FILES_END):
-                        continue
-                    if repo_file.startswith(IGNORED_FILES_START):
-                        continue
-                    if any(match for match in ignored_files if repo_file == match):
-                        continue
-
                     full_path = os.path.join(root, repo_file)
-                    if any(bl in full_path for bl in IGNORED_DIRECTORIES):
-                        continue
-
                     archive_name = os.path.join(archive_root, repo_file)
-                    if (repo_file == 'addon.xml' and is_py3(self.addon_xml) and
-                            MATRIX_BUILD_VERSION):
-                        archive_name = archive_name.lstrip('/').lstrip('\\')
-                        zipped_file.writestr(archive_name,
-                                             etree.tostring(self.addon_xml, encoding='utf-8',
-                                                            doctype='<?xml version="1.0" '
-                                                                    'encoding="UTF-8" '
-                                                                    'standalone="yes"?>'),
-                                             zipfile.ZIP_DEFLATED)
+                    if repo_file == 'addon.xml' and root == directory:
+                        if include_addon_xml:
+                            self._zip_addon_xml(zipped_file, archive_name, full_path)
                     else:
-                        archive_name = os.path.join(archive_root, repo_file)
-                        zipped_file.write(full_path, archive_name, zipfile.ZIP_DEFLATED)
+                        zipped_file.write(full_path, archive_name,
+                                          **COMPRESSION_POLICY.get(repo_file, full_path))
+
+            phase.add_bytes(sum(info.file_size for info in zipped_file.infolist()))
+
+    def _zip_addon_xml(self, zipped_file, archive_name, full_path):
+        if self.metadata.matrix_addon_xml:
+            archive_name = archive_name.lstrip('/').lstrip('\\')
+            zipped_file.writestr(archive_name, self.metadata.matrix_addon_xml,
+                                 **COMPRESSION_POLICY.get('addon.xml'))
+        else:
+            zipped_file.write(full_path, archive_name,
+                              **COMPRESSION_POLICY.get('addon.xml', full_path))
+
+    def create_compressed_addon_releases(self, releases):
+        # create the zips of the add-on for every build target in releases. targets
+        # get the same zip unless their addon.xml differs (matrix version number), the
+        # other files are then compressed once into a shared zip that is copied for each
+        # addon.xml variant before its addon.xml is appended
+        variants = collections.OrderedDict()
+        for target, metadata in releases:
+            variants.setdefault(metadata.matrix_addon_xml, []).append((target, metadata))
+
+        common_zip = None
+        if len(variants) > 1:
+            self._set_target(*releases[0])
+            common_zip = os.path.join(self.target.zips_path, self.addon_name + '.common.zip')
+            self.recursive_zipper(self.addon_path, common_zip, include_addon_xml=False)
 
-    def create_compressed_addon_release(self):
+        try:
+            for variant in variants.values():
+                zip_path = None
+                for target, metadata in variant:
+                    self._set_target(target, metadata)
+                    zip_path = self.create_compressed_addon_release(zip_path, common_zip)
+        finally:
+            if common_zip and os.path.exists(common_zip):
+                os.remove(common_zip)
+
+    def create_compressed_addon_release(self, copy_from=None, common_zip=None):
         # create a zip of the addon into repo root directory,
-        # tagging it with '-x.x.x' release number scraped from addon.xml
+        # tagging it with '-x.x.x' release number scraped from addon.xml.
+        # copy_from is an identical zip already built for another build target,
+        # returns the path of the released zip
 
         def _copy_asset(asset):
             if not asset:
-                return
+                return False
             if asset == 'changelog.txt':
-                asset = 'changelog-' + self.addon_version_number + '.txt'
+                asset = 'changelog-' + self.metadata.version + '.txt'
 
             asset_path = os.path.join(self.addon_path_zips, asset)
-            try:
+            with profile_phase('copy', self.addon_name) as phase:
                 try:
-                    os.makedirs(os.path.dirname(asset_path))
-                except(IOError, OSError) as _:
-                    pass
-
-                if asset == 'addon.xml' and is_py3(self.addon_xml) and MATRIX_BUILD_VERSION:
-                    with open(asset_path, 'wb') as open_file:
-                        open_file.write(etree.tostring(self.addon_xml, encoding='utf-8',
-                                                       doctype='<?xml version="1.0" '
-                                                               'encoding="UTF-8" '
-                                                               'standalone="yes"?>'))
-                else:
-                    shutil.copyfile(os.path.join(self.addon_path, asset), asset_path)
-            except (shutil.Error, IOError) as _:
-                pass
-
-        zip_name = self._get_zip_name()
-        zip_path = os.path.join(ZIPS_PATH, zip_name)
+                    try:
+                        os.makedirs(os.path.dirname(asset_path))
+                    except(IOError, OSError) as _:
+                        pass
+
+                    if asset == 'addon.xml' and self.metadata.matrix_addon_xml:
+                        with open(asset_path, 'wb') as open_file:
+                            open_file.write(self.metadata.matrix_addon_xml)
+                    else:
+                        shutil.copyfile(os.path.join(self.addon_path, asset), asset_path)
+                    phase.add_bytes(os.path.getsize(asset_path))
+                except (shutil.Error, IOError, OSError) as _:
+                    return False
+            return True
 
-        # zip full directories
-        self.recursive_zipper(self.addon_path, zip_path)
+        zip_name = self.metadata.get_zip_name()
+        zip_path = os.path.join(self.target.zips_path, zip_name)
+
+        if copy_from:
+            # reuse the compressed zip of a target with the same contents
+            with profile_phase('zip', self.addon_name) as phase:
+                shutil.copyfile(copy_from, zip_path)
+                phase.add_bytes(os.path.getsize(zip_path))
+        elif common_zip:
+            # add this target's addon.xml to a copy of the shared zip
+            with profile_phase('zip', self.addon_name) as phase:
+                shutil.copyfile(common_zip, zip_path)
+                with zipfile.ZipFile(zip_path, 'a') as zipped_file:
+                    self._zip_addon_xml(zipped_file,
+                                        os.path.join(self.addon_name, 'addon.xml'),
+                                        os.path.join(self.addon_path, 'addon.xml'))
+                phase.add_bytes(os.path.getsize(zip_path))
+        else:
+            # zip full directories
+            self.recursive_zipper(self.addon_path, zip_path)
 
         # now move the zip into the addon folder,
         # which we will now treat as the 'addon release directory'
 
-        os.rename(zip_path, os.path.join(self.addon_path_zips, zip_name))
+        release_path = os.path.join(self.addon_path_zips, zip_name)
+        if os.path.exists(release_path):
+            # rebuilding a release whose source changed without a version bump
+            os.remove(release_path)
+        os.rename(zip_path, release_path)
+        self._get_release_index(self.addon_path_zips).add(zip_name, self.metadata.version)
 
-        if ((is_unofficial(self.xml_file) and UNOFFICIAL_COMPRESS_ONLY) or
-                (is_py3(self.addon_xml) and PYTHON3_COMPRESS_ONLY)):
-            return
+        if ((self.metadata.unofficial and self.target.unofficial_compress_only) or
+                (self.metadata.python3 and self.target.python3_compress_only)):
+            return release_path
 
-        art = self._get_artwork()
+        art = self.metadata.artwork
 
-        _copy_asset('addon.xml')
+        if _copy_asset('addon.xml'):
+            # Generator can use the metadata instead of reading the released addon.xml
+            self.released_metadata[self.target.name] = self.metadata
         _copy_asset('changelog.txt')
         _copy_asset(art.get('icon', 'icon.png'))
         _copy_asset(art.get('fanart', 'fanart.jpg'))
@@ -322,23 +725,96 @@ class Compressor:
         for screenshot in art.get('screenshot', []):
             _copy_asset(screenshot)
 
+        return release_path
+
     def _read_addon_xml(self):
-        # check for addon.xml and try and read it.
-        addon_xml_path = os.path.join(self.addon_path, 'addon.xml')
-        if os.path.exists(addon_xml_path):
-            # load whole text into string
-            self.xml_file = read_file(addon_xml_path)
-            self.addon_xml = etree.fromstring(self.xml_file.encode('utf-8'))
-            # return True if we found and read the addon.xml
-            return True
-        # return False if we couldn't  find the addon.xml
-        return False
+        # check for addon.xml and try and read it, only once per add-on.
+        if self.source_metadata is None:
+            addon_xml_path = os.path.join(self.addon_path, 'addon.xml')
+            if os.path.exists(addon_xml_path):
+                with profile_phase('parse', self.addon_name) as phase:
+                    self.source_metadata = AddonMetadata(self.addon_name, addon_xml_path)
+                    phase.add_bytes(len(self.source_metadata.xml_file))
+        # return True if we found and read the addon.xml
+        return self.source_metadata is not None
+
+
+class AddonMetadata:
+    """
+        Everything a build target needs from an add-on's addon.xml, parsed once per
+        add-on and target and shared by Compressor, recursive_zipper, the release
+        assets and Generator. The file itself is only read once for all targets.
+    """
+
+    def __init__(self, addon_name, addon_xml_path, target=None, xml_file=None):
+        self.addon_name = addon_name
+        self.addon_xml_path = addon_xml_path
+
+        target = target or TARGETS[0]
+        self.target_name = target.name
+        self.matrix_build_version = target.matrix_build_version
+        self.tag_unofficial_releases = target.tag_unofficial_releases
+
+        # load whole text into string
+        self.xml_file = xml_file if xml_file is not None else read_file(addon_xml_path)
+        self.addon_xml = etree.fromstring(self.xml_file.encode('utf-8'))
+
+        self.python3 = is_py3(self.addon_xml)
+        self.unofficial = bool(is_unofficial(self.xml_file))
+        self.version = self._read_version_number()
+        self.artwork = self._get_artwork()
+
+        # the addon.xml with the matrix version number, used for the zip and release folder
+        self.matrix_addon_xml = None
+        if self.python3 and self.matrix_build_version:
+            self.matrix_addon_xml = etree.tostring(self.addon_xml, encoding='utf-8',
+                                                   doctype='<?xml version="1.0" '
+                                                           'encoding="UTF-8" '
+                                                           'standalone="yes"?>')
+
+    def __getstate__(self):
+        # lxml elements can't be pickled, drop the tree when sent back from a worker process
+        state = self.__dict__.copy()
+        state['addon_xml'] = None
+        return state
+
+    def for_target(self, target):
+        # the add-on as seen by another build target, without reading addon.xml again
+        if target.name == self.target_name:
+            return self
+        return AddonMetadata(self.addon_name, self.addon_xml_path, target, self.xml_file)
+
+    def get_release_addon_xml(self):
+        # the contents of the addon.xml copied to the release folder
+        if self.matrix_addon_xml:
+            return self.matrix_addon_xml.decode('utf-8')
+        return self.xml_file
+
+    def get_zip_name(self):
+        zip_name = self.addon_name
+
+        if self.tag_unofficial_releases and self.unofficial:
+            zip_name += '-unofficial'
+
+        zip_name += '-' + self.version + '.zip'
+
+        return zip_name
+
+    def get_release_type(self):
+        if 'alpha' in self.version:
+            tag = 'alpha'
+        elif 'beta' in self.version:
+            tag = 'beta'
+        else:
+            tag = 'stable'
+
+        return tag
 
     def _read_version_number(self):
         # find the header of the addon.
         version = self.addon_xml.get('version')
         addon_version = version
-        if is_py3(self.addon_xml) and MATRIX_BUILD_VERSION:
+        if self.python3 and self.matrix_build_version:
             t_version = split_version(version)
             if 'alpha' or 'beta' in t_version[-1]:
                 t_version.insert(-1, '+matrix.1')
@@ -356,21 +832,7 @@ class Compressor:
 
             self.addon_xml.set('version', addon_version)
 
-        self.addon_version_number = addon_version
-
-    def _get_release_type(self):
-
-        if not self.addon_version_number:
-            self._read_version_number()
-
-        if 'alpha' in self.addon_version_number:
-            tag = 'alpha'
-        elif 'beta' in self.addon_version_number:
-            tag = 'beta'
-        else:
-            tag = 'stable'
-
-        return tag
+        return addon_version
 
     def _get_artwork(self):
         art = {
@@ -409,6 +871,1018 @@ class Compressor:
         return art
 
 
+class ReleaseIndex:
+    """
+        The release zips in an add-on's release folder, kept in the folder as
+        .releases.json so finding a release and pruning old ones don't list the
+        folder. The folder is only listed when there is no index yet, or with
+        --force. Releases are ordered by the time they were built.
+    """
+
+    FILENAME = '.releases.json'
+
+    def __init__(self, path):
+        self.path = path
+        self.filename = os.path.join(path, self.FILENAME)
+        self.changed = False
+
+        # zip name -> {'version': version, 'built': timestamp}
+        self.releases = None
+        if not FORCE_REBUILD and os.path.exists(self.filename):
+            try:
+                self.releases = read_file(self.filename, is_json=True)['releases']
+            except (ValueError, KeyError) as error:
+                print('Ignoring unreadable release index %s\n%s' % (self.filename, error))
+
+        if self.releases is None:
+            self.releases = self._scan()
+            self.changed = True
+
+    def _scan(self):
+        releases = {}
+        if not os.path.isdir(self.path):
+            return releases
+
+        addon = os.path.basename(os.path.normpath(self.path))
+        with profile_phase('list', addon):
+            for filename in os.listdir(self.path):
+                if not filename.startswith(addon + '-') or not filename.endswith('.zip'):
+                    continue
+                version = filename[len(addon) + 1:-len('.zip')]
+                if version.startswith('unofficial-'):
+                    version = version[len('unofficial-'):]
+                releases[filename] = {
+                    'version': version,
+                    'built': os.path.getmtime(os.path.join(self.path, filename)),
+                }
+        return releases
+
+    def has(self, zip_name):
+        # the zip itself is checked in case it was removed by hand
+        if zip_name in self.releases:
+            if os.path.exists(os.path.join(self.path, zip_name)):
+                return True
+            del self.releases[zip_name]
+            self.changed = True
+        return False
+
+    def add(self, zip_name, version):
+        self.releases[zip_name] = {'version': version, 'built': time.time()}
+        self.changed = True
+
+    def prune(self, retention, current):
+        # remove the zips retention doesn't keep and changelogs no other release uses,
+        # the current release is always kept. returns the removed zip names
+        removed = retention.get_expired(self.releases, current)
+        for zip_name in removed:
+            version = self.releases.pop(zip_name)['version']
+            self.changed = True
+            remove_file(os.path.join(self.path, zip_name))
+            if all(release['version'] != version for release in self.releases.values()):
+                remove_file(os.path.join(self.path, 'changelog-' + version + '.txt'))
+        return removed
+
+    def save(self):
+        if not self.changed or not os.path.isdir(self.path):
+            return
+        save_file(self.filename, json.dumps({'releases': self.releases}, indent=1,
+                                            sort_keys=True))
+        self.changed = False
+
+
+class RetentionPolicy:
+    """
+        Which release zips of an add-on are kept. keep_versions keeps that many of
+        the newest releases, keep_newer_than keeps every release built since that
+        date (YYYY-MM-DD). A release is kept if either keeps it, with neither set
+        every release is kept.
+    """
+
+    def __init__(self, retention):
+        self.keep_versions = int(retention.get('keep_versions', 0) or 0)
+        self.keep_newer_than = retention.get('keep_newer_than', '')
+        self.newer_than = None
+        if self.keep_newer_than:
+            self.newer_than = time.mktime(time.strptime(self.keep_newer_than, '%Y-%m-%d'))
+        self.enabled = self.keep_versions > 0 or self.newer_than is not None
+
+    def __str__(self):
+        if not self.enabled:
+            return 'keep all'
+        policies = []
+        if self.keep_versions > 0:
+            policies.append('keep %d versions' % self.keep_versions)
+        if self.newer_than is not None:
+            policies.append('keep newer than ' + self.keep_newer_than)
+        return ', '.join(policies)
+
+    def get_expired(self, releases, current):
+        if not self.enabled:
+            return []
+        newest = sorted(releases, key=lambda zip_name: releases[zip_name]['built'], reverse=True)
+        expired = []
+        for position, zip_name in enumerate(newest):
+            if zip_name == current or position < self.keep_versions:
+                continue
+            if self.newer_than is not None and releases[zip_name]['built'] >= self.newer_than:
+                continue
+            expired.append(zip_name)
+        return expired
+
+
+class BuildManifest:
+    """
+        Persistent record of the previous build of a target, one entry per add-on.
+        Compressor entries hold the add-on's file tree hashes and the metadata
+        read from its addon.xml, Generator entries hold the size and mtime of
+        each released addon.xml.
+        The manifest is discarded when the target's configuration fingerprint
+        changes, without a path it is only kept in memory.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.changed = False
+
+        self.data = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                self.data = read_file(self.path, is_json=True)
+            except ValueError as error:
+                print('Ignoring unreadable build manifest %s\n%s' % (self.path, error))
+
+        if (self.data.get('version') != self.VERSION or
+                self.data.get('config') != fingerprint):
+            self.data = {
+                'version': self.VERSION,
+                'config': fingerprint,
+                'compressor': {},
+                'generator': {},
+            }
+            self.changed = True
+
+    def get(self, section, addon):
+        return self.data[section].get(addon)
+
+    def set(self, section, addon, entry):
+        if self.data[section].get(addon) != entry:
+            self.data[section][addon] = entry
+            self.changed = True
+
+    def remove(self, section, addon):
+        if addon in self.data[section]:
+            del self.data[section][addon]
+            self.changed = True
+
+    def prune(self, section, addons):
+        # remove entries of add-ons that no longer exist, returns True if any were removed
+        removed = [addon for addon in self.data[section] if addon not in addons]
+        for addon in removed:
+            del self.data[section][addon]
+        if removed:
+            self.changed = True
+        return bool(removed)
+
+    def save(self):
+        if not self.changed or not self.path:
+            return
+        save_file(self.path, json.dumps(self.data, indent=1, sort_keys=True))
+        self.changed = False
+
+
+class IgnoreMatcher:
+    """
+        Compiled form of the 'ignored' settings. File names are matched with set
+        and tuple lookups, 'directories' and the gitignore style 'patterns' are
+        compiled to regular expressions once, and walk() prunes ignored
+        directories so their contents are never listed.
+
+        Patterns are relative to the add-on folder: a trailing '/' only matches
+        directories, a pattern containing a '/' is anchored to the add-on folder,
+        '*' and '?' don't match '/', '**' matches any number of directories and
+        a leading '!' re-includes a file ignored by an earlier pattern.
+    """
+
+    def __init__(self, ignored):
+        self.files = frozenset(ignored.get('files', []))
+        self.file_starts_with = tuple(set(ignored.get('file_starts_with', [])))
+        self.file_ends_with = tuple(set(ignored.get('file_ends_with', [])))
+
+        self.directory_names = set()
+        self.patterns = []
+        for directory in ignored.get('directories', []):
+            directory = directory.strip('/')
+            if '/' in directory or any(char in directory for char in '*?['):
+                self.patterns.append(compile_ignore_pattern(directory + '/'))
+            else:
+                self.directory_names.add(directory)
+        for pattern in ignored.get('patterns', []):
+            self.patterns.append(compile_ignore_pattern(pattern))
+
+    def _matches_patterns(self, relative_path, is_directory):
+        ignored = False
+        for regex, negate, directory_only in self.patterns:
+            if directory_only and not is_directory:
+                continue
+            if ignored == negate and regex.match(relative_path):
+                ignored = not negate
+        return ignored
+
+    def ignores_directory(self, relative_path, name):
+        if name in self.directory_names:
+            return True
+        return self._matches_patterns(relative_path, True)
+
+    def ignores_file(self, relative_path, name, extra_files=()):
+        if name in self.files or name in extra_files:
+            return True
+        if name.startswith(self.file_starts_with) or name.endswith(self.file_ends_with):
+            return True
+        return self._matches_patterns(relative_path, False)
+
+    def ignores_path(self, relative_path, extra_files=()):
+        # check a '/' separated file path, including every directory above it
+        parts = relative_path.strip('/').split('/')
+        for index in range(1, len(parts)):
+            if self.ignores_directory('/'.join(parts[:index]), parts[index - 1]):
+                return True
+        return self.ignores_file('/'.join(parts), parts[-1], extra_files)
+
+    def walk(self, directory, extra_files=()):
+        # os.walk that prunes ignored directories and filters ignored files,
+        # yields the root, the root relative to directory ('' or ending in '/')
+        # and the sorted file names
+        for root, dirs, files in os.walk(directory):
+            relative_root = os.path.relpath(root, directory).replace('\\', '/')
+            relative_root = '' if relative_root == '.' else relative_root + '/'
+            dirs[:] = [name for name in sorted(dirs)
+                       if not self.ignores_directory(relative_root + name, name)]
+            files = [name for name in sorted(files)
+                     if not self.ignores_file(relative_root + name, name, extra_files)]
+            yield root, relative_root, files
+
+
+def compile_ignore_pattern(pattern):
+    # translate a gitignore style pattern to (regex, negate, directory_only)
+    negate = pattern.startswith('!')
+    if negate:
+        pattern = pattern[1:]
+    directory_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    regex = ''
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith('**/', index):
+            regex += '(?:.*/)?'
+            index += 3
+            continue
+        if pattern.startswith('**', index):
+            regex += '.*'
+            index += 2
+            continue
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[' and ']' in pattern[index + 1:]:
+            end = pattern.index(']', index + 1)
+            characters = pattern[index + 1:end]
+            if characters.startswith('!'):
+                characters = '^' + characters[1:]
+            regex += '[' + characters.replace('\\', '\\\\') + ']'
+            index = end
+        else:
+            regex += re.escape(char)
+        index += 1
+
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return re.compile('^' + regex + '$'), negate, directory_only
+
+
+class CompressionPolicy:
+    """
+        Decides how each file is compressed in an add-on zip. Files with a
+        'stored' extension are stored without compression, 'levels' maps
+        extensions to a deflate level (Python 3.7+) and, when 'entropy_sample'
+        is set, that many bytes of every other file are sampled and files above
+        'entropy_threshold' bits per byte are stored as well.
+    """
+
+    def __init__(self, policy):
+        self.stored = tuple(set(extension.lower() for extension in policy.get('stored', [])))
+        self.levels = dict((extension.lower(), int(level))
+                           for extension, level in policy.get('levels', {}).items())
+        self.default_level = policy.get('default_level')
+        self.entropy_sample = int(policy.get('entropy_sample', 0))
+        self.entropy_threshold = float(policy.get('entropy_threshold', 7.5))
+
+    def get(self, filename, full_path=None):
+        # returns the keyword arguments for ZipFile.write/writestr
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in self.stored:
+            return {'compress_type': zipfile.ZIP_STORED}
+
+        if (full_path and self.entropy_sample > 0 and
+                get_entropy(full_path, self.entropy_sample) > self.entropy_threshold):
+            return {'compress_type': zipfile.ZIP_STORED}
+
+        options = {'compress_type': zipfile.ZIP_DEFLATED}
+        level = self.levels.get(extension, self.default_level)
+        if level is not None and sys.version_info >= (3, 7):
+            options['compresslevel'] = int(level)
+        return options
+
+
+def get_entropy(filename, sample_size):
+    # shannon entropy in bits per byte of the first sample_size bytes of filename
+    with open(filename, 'rb') as open_file:
+        sample = bytearray(open_file.read(sample_size))
+    if not sample:
+        return 0.0
+
+    entropy = 0.0
+    for count in collections.Counter(sample).values():
+        probability = float(count) / len(sample)
+        entropy -= probability * math.log(probability, 2)
+    return entropy
+
+
+class Watcher:
+    """
+        Watch mode, keeps the repository up to date while add-ons are edited.
+        Changes under SOURCE_PATH are collected until the source has been quiet
+        for 'settle_time' seconds, then only the changed add-ons are compressed
+        and only their entries in addons.xml are replaced.
+    """
+
+    def __init__(self):
+        # an in memory manifest is used when build_manifest is disabled
+        for target in TARGETS:
+            if not target.manifest:
+                target.manifest = BuildManifest(None, target.fingerprint)
+        self.compressor = Compressor(auto_run=False)
+        self.generators = dict((target.name, Generator(target, auto_run=False))
+                               for target in TARGETS)
+
+        watch = CONFIG.get('watch', {})
+        self.poll_interval = float(watch.get('poll_interval', 1.0))
+        self.settle_time = float(watch.get('settle_time', 0.25))
+
+        self.changes = None
+        try:
+            self.changes = InotifyChanges()
+        except (OSError, AttributeError) as error:
+            print('inotify is unavailable (%s), polling every %ss' % (error, self.poll_interval))
+            self.changes = PollingChanges()
+
+    def run(self):
+        # the initial build records every add-on, after it only changes are built
+        if COMPRESS_ADDONS:
+            self.compressor.compress_addons()
+        for target in TARGETS:
+            generator = self.generators[target.name]
+            generator.released = self.compressor.released[target.name]
+            generator.generate_addons_files()
+            generator.load_entries()
+            target.manifest.save()
+
+        print(' ')
+        print('Watching %s for changes, press Ctrl+C to stop' % SOURCE_PATH)
+        try:
+            while True:
+                changed = self.changes.wait(self.poll_interval)
+                if not changed:
+                    continue
+                # wait for the source to settle, editors and checkouts write in bursts
+                while True:
+                    more = self.changes.wait(self.settle_time)
+                    if not more:
+                        break
+                    changed.update(more)
+                self.rebuild(changed)
+        except KeyboardInterrupt:
+            print('Stopped watching')
+        finally:
+            self.changes.close()
+
+    def rebuild(self, addons):
+        started = time.time()
+        updated = []
+        for addon in sorted(addons):
+            if addon in IGNORED_ADDONS:
+                continue
+            if not is_addon_dir(os.path.join(SOURCE_PATH, addon)):
+                # removed from the source, its releases are left in place
+                for target in TARGETS:
+                    target.manifest.remove('compressor', addon)
+                continue
+            if not COMPRESS_ADDONS:
+                continue
+
+            entries = dict((target.name, target.manifest.get('compressor', addon))
+                           for target in TARGETS if target.manifest.get('compressor', addon))
+            error, entries, released = self.compressor.compress_addon(addon, entries)
+            if error:
+                print('Failed to compress [%s]: %s' % (addon, error))
+                continue
+            for target in TARGETS:
+                if target.name in entries:
+                    target.manifest.set('compressor', addon, entries[target.name])
+                metadata = released.get(target.name)
+                if metadata and self.generators[target.name].update_addon(addon, metadata):
+                    if addon not in updated:
+                        updated.append(addon)
+
+        for target in TARGETS:
+            target.manifest.save()
+        if updated:
+            print('Updated %s in addons.xml in %dms' %
+                  (', '.join('[%s]' % addon for addon in updated),
+                   (time.time() - started) * 1000))
+
+
+class InotifyChanges:
+    """
+        Collects the add-ons changed under SOURCE_PATH using Linux inotify,
+        every non-ignored directory of every add-on is watched
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('not supported on %s' % sys.platform)
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.file_descriptor = self.libc.inotify_init()
+        if self.file_descriptor < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        self.mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM |
+                     self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE | self.IN_DELETE_SELF)
+        # watch descriptor -> path relative to SOURCE_PATH, '' is SOURCE_PATH itself
+        self.watches = {}
+        self._add_watch('')
+        for addon in list_source_addons():
+            self._add_addon_watches(addon)
+
+    def _add_watch(self, relative_path):
+        path = os.path.join(SOURCE_PATH, relative_path) if relative_path else SOURCE_PATH
+        watch_descriptor = self.libc.inotify_add_watch(self.file_descriptor,
+                                                       path.encode(sys.getfilesystemencoding()),
+                                                       self.mask)
+        if watch_descriptor >= 0:
+            self.watches[watch_descriptor] = relative_path
+
+    def _add_addon_watches(self, addon):
+        # watch every directory of the add-on that isn't ignored, directories that
+        # are already watched keep their watch descriptor
+        for _, relative_root, _ in IGNORE_MATCHER.walk(os.path.join(SOURCE_PATH, addon)):
+            self._add_watch((addon + '/' + relative_root).rstrip('/'))
+
+    def wait(self, timeout):
+        # returns the set of changed add-ons, empty if nothing changed before the timeout
+        changed = set()
+        readable, _, _ = select.select([self.file_descriptor], [], [], timeout)
+        if not readable:
+            return changed
+
+        data = os.read(self.file_descriptor, 65536)
+        offset = 0
+        while offset < len(data):
+            watch_descriptor, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                # events were lost, check every add-on
+                changed.update(list_source_addons())
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(watch_descriptor, None)
+                continue
+
+            relative_path = self.watches.get(watch_descriptor)
+            if relative_path is None:
+                continue
+            if not relative_path:
+                # a change directly in SOURCE_PATH, only add-on folders matter
+                if mask & self.IN_ISDIR and name not in IGNORED_ADDONS:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self._add_addon_watches(name)
+                    changed.add(name)
+                continue
+
+            addon, _, addon_relative_path = relative_path.partition('/')
+            if addon_relative_path:
+                addon_relative_path += '/'
+            if mask & self.IN_ISDIR:
+                if IGNORE_MATCHER.ignores_directory(addon_relative_path + name, name):
+                    continue
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._add_addon_watches(addon)
+            elif name and IGNORE_MATCHER.ignores_file(addon_relative_path + name, name):
+                continue
+            changed.add(addon)
+
+        return changed
+
+    def close(self):
+        os.close(self.file_descriptor)
+
+
+class PollingChanges:
+    """
+        Collects the add-ons changed under SOURCE_PATH by comparing the
+        mtimes and sizes of their files on every poll
+    """
+
+    def __init__(self):
+        self.stats = self._get_stats()
+
+    @staticmethod
+    def _get_stats():
+        stats = {}
+        for addon in list_source_addons():
+            try:
+                stats[addon] = get_tree_stats(os.path.join(SOURCE_PATH, addon))[0]
+            except OSError:
+                # removed while it was being read
+                pass
+        return stats
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        stats = self._get_stats()
+        changed = set(addon for addon in set(stats) | set(self.stats)
+                      if stats.get(addon) != self.stats.get(addon))
+        self.stats = stats
+        return changed
+
+    def close(self):
+        pass
+
+
+class Verifier:
+    """
+        Verify mode, checks the built repository of every target without changing
+        it. Every zip is read in full so the CRC of each file is checked, the
+        addon.xml in it must have the add-on's id and the version in the zip's
+        name and it mustn't contain ignored files. The release zip of every add-on
+        in addons.xml must hold the same version, and the checksum files must
+        match addons.xml and its compressed copies. Zips are checked in parallel.
+    """
+
+    def __init__(self):
+        self.problems = []
+
+    def run(self):
+        # returns True if no problems were found
+        started = time.time()
+        zip_count = 0
+        for target in TARGETS:
+            zips = self._list_zips(target)
+            zip_count += len(zips)
+            releases = {}
+            for path, addon_id, version, problems in self._verify_zips(zips):
+                for problem in problems:
+                    self.problems.append('%s: %s' % (path, problem))
+                releases.setdefault(addon_id, set()).add(version)
+            self._verify_index(target, releases)
+
+        for problem in self.problems:
+            print(problem)
+        print(' ')
+        print('Verified %d zips in %.2fs, %d problem(s) found' %
+              (zip_count, time.time() - started, len(self.problems)))
+        return not self.problems
+
+    @staticmethod
+    def _list_zips(target):
+        zips = []
+        for addon in os.listdir(target.zips_path or os.curdir):
+            addon_path = os.path.join(target.zips_path, addon)
+            if addon in IGNORED_ADDONS or not is_addon_dir(addon_path):
+                continue
+            zips.extend(os.path.join(addon_path, filename)
+                        for filename in sorted(os.listdir(addon_path))
+                        if filename.endswith('.zip'))
+        return zips
+
+    @staticmethod
+    def _verify_zips(zips):
+        # verification is read only, use a process per cpu core
+        workers = min(get_worker_count(0), len(zips))
+        if workers <= 1:
+            return [verify_zip(path) for path in zips]
+
+        pool = multiprocessing.Pool(processes=workers, initializer=load_config,
+                                    initargs=(CONFIG,))
+        try:
+            return pool.map(verify_zip, zips, chunksize=4)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _verify_index(self, target, releases):
+        addons_xml = os.path.join(target.repository_path, 'addons.xml')
+        try:
+            index = etree.parse(addons_xml).getroot()
+        except (IOError, OSError, etree.XMLSyntaxError) as error:
+            self.problems.append('%s: %s' % (addons_xml, error))
+            return
+
+        for addon in index.findall('addon'):
+            addon_id = addon.get('id')
+            version = addon.get('version')
+            if version not in releases.get(addon_id, ()):
+                self.problems.append('%s: no release zip of [%s] v%s' %
+                                     (addons_xml, addon_id, version))
+
+        for filename in [addons_xml] + [addons_xml + '.' + extension
+                                        for extension in target.index_compression]:
+            for algorithm in target.checksums:
+                checksum_file = filename + '.' + algorithm
+                try:
+                    with open(filename, 'rb') as open_file:
+                        checksum = hashlib.new(algorithm)
+                        for chunk in iter(lambda: open_file.read(65536), b''):
+                            checksum.update(chunk)
+                    expected = read_file(checksum_file).strip()
+                except (IOError, OSError) as error:
+                    self.problems.append('%s: %s' % (checksum_file, error))
+                    continue
+                if checksum.hexdigest() != expected:
+                    self.problems.append('%s: does not match %s' %
+                                         (checksum_file, os.path.basename(filename)))
+
+
+def verify_zip(path):
+    # read a release zip in full, returns its path, the id and version from its
+    # addon.xml and a list of problems
+    addon = os.path.basename(os.path.dirname(path))
+    addon_id = None
+    version = None
+    problems = []
+    try:
+        with zipfile.ZipFile(path, 'r') as zipped_file:
+            for info in zipped_file.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                folder, _, relative_path = info.filename.partition('/')
+                if folder != addon or not relative_path:
+                    problems.append('%s is outside the %s folder' % (info.filename, addon))
+                elif IGNORE_MATCHER.ignores_path(relative_path):
+                    problems.append('contains ignored file %s' % info.filename)
+
+                # reading to the end of each file checks its CRC
+                if relative_path == 'addon.xml' and folder == addon:
+                    addon_xml = etree.fromstring(zipped_file.read(info))
+                    addon_id = addon_xml.get('id')
+                    version = addon_xml.get('version')
+                else:
+                    with zipped_file.open(info) as open_file:
+                        while open_file.read(65536):
+                            pass
+    except (zipfile.BadZipfile, zlib.error, etree.XMLSyntaxError,
+            IOError, OSError, EOFError) as error:
+        problems.append('%s: %s' % (error.__class__.__name__, error))
+        return path, addon_id, version, problems
+
+    if version is None:
+        problems.append('has no %s/addon.xml' % addon)
+    else:
+        if addon_id != addon:
+            problems.append('addon.xml has id %s' % addon_id)
+        zip_names = [addon + '-' + version + '.zip', addon + '-unofficial-' + version + '.zip']
+        if os.path.basename(path) not in zip_names:
+            problems.append('addon.xml has version %s' % version)
+    return path, addon_id, version, problems
+
+
+class BuildProfile:
+    """
+        Wall time and bytes processed per add-on and build phase, recorded with
+        --profile. A phase nested in another is only counted once, the outer
+        phase is paused while it runs. Worker processes keep their own profile
+        and send it back with each add-on they compressed.
+    """
+
+    PHASES = ('list', 'hash', 'parse', 'zip', 'copy', 'assemble', 'checksum')
+
+    def __init__(self):
+        self.started = TIMER()
+        # (add-on, phase) -> [seconds, bytes, calls]
+        self.records = {}
+        self.running = []
+
+    def add(self, addon, phase, seconds, size=0, calls=1):
+        record = self.records.setdefault((addon, phase), [0.0, 0, 0])
+        record[0] += seconds
+        record[1] += size
+        record[2] += calls
+
+    def drain(self):
+        # the records as a picklable list, clearing them
+        records = [key + tuple(record) for key, record in self.records.items()]
+        self.records = {}
+        return records
+
+    def merge(self, records):
+        for addon, phase, seconds, size, calls in records:
+            self.add(addon, phase, seconds, size, calls)
+
+    def get_totals(self, index):
+        # records summed by add-on (index 0) or phase (index 1)
+        totals = {}
+        for key, record in self.records.items():
+            total = totals.setdefault(key[index], [0.0, 0, 0])
+            for position, value in enumerate(record):
+                total[position] += value
+        return totals
+
+    def report(self, limit=20):
+        wall = TIMER() - self.started
+        phases = self.get_totals(1)
+        busy = sum(record[0] for record in phases.values()) or 1.0
+
+        print(' ')
+        print('Profile, %.3fs wall time, %d worker(s):' % (wall, get_worker_count()))
+        print('    %-10s %10s %7s %12s %12s %8s' %
+              ('Phase', 'Time', 'Share', 'Bytes', 'Rate', 'Calls'))
+        for phase, record in sorted(phases.items(), key=lambda item: -item[1][0]):
+            print('    %-10s %9.3fs %6.1f%% %12s %10s/s %8d' %
+                  (phase, record[0], record[0] / busy * 100.0, format_size(record[1]),
+                   format_size(record[1] / record[0] if record[0] else 0), record[2]))
+
+        addons = self.get_totals(0)
+        if addons:
+            print(' ')
+            print('    Slowest add-ons:')
+            print('    %-40s %10s %12s  %s' % ('Add-on', 'Time', 'Bytes', 'Slowest phase'))
+        for addon, record in sorted(addons.items(), key=lambda item: -item[1][0])[:limit]:
+            slowest = max((value[0], phase) for (name, phase), value in self.records.items()
+                          if name == addon)
+            print('    %-40s %9.3fs %12s  %s %.3fs' %
+                  (addon, record[0], format_size(record[1]), slowest[1], slowest[0]))
+        if get_worker_count() > 1:
+            print('    phase times are summed over the worker processes')
+
+    def save(self, path):
+        addons = {}
+        for (addon, phase), record in self.records.items():
+            addons.setdefault(addon, {})[phase] = dict(zip(('seconds', 'bytes', 'calls'), record))
+        phases = dict((phase, dict(zip(('seconds', 'bytes', 'calls'), record)))
+                      for phase, record in self.get_totals(1).items())
+        save_file(path, json.dumps({
+            'revision': __revision__,
+            'wall': TIMER() - self.started,
+            'workers': get_worker_count(),
+            'phases': phases,
+            'addons': addons,
+        }, indent=1, sort_keys=True))
+
+
+class ProfilePhase:
+    """
+        Context manager timing one phase of the build for BuildProfile,
+        does nothing when the build isn't profiled
+    """
+
+    def __init__(self, profile, phase, addon):
+        self.profile = profile
+        self.phase = phase
+        self.addon = addon
+        self.seconds = 0.0
+        self.bytes = 0
+        self.resumed = None
+
+    def __enter__(self):
+        if self.profile is not None:
+            now = TIMER()
+            if self.profile.running:
+                self.profile.running[-1].pause(now)
+            self.profile.running.append(self)
+            self.resumed = now
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.profile is not None:
+            now = TIMER()
+            self.pause(now)
+            self.profile.running.pop()
+            if self.profile.running:
+                self.profile.running[-1].resumed = now
+            self.profile.add(self.addon, self.phase, self.seconds, self.bytes)
+
+    def pause(self, now):
+        self.seconds += now - self.resumed
+
+    def add_bytes(self, size):
+        self.bytes += size
+
+
+def profile_phase(phase, addon=None):
+    # time a phase of the build for an add-on, or for the whole build without one
+    return ProfilePhase(PROFILE, phase, addon or '(build)')
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f GB' % size
+
+
+def list_source_addons():
+    # the repository and zips folders of the build targets aren't add-ons
+    output_paths = set()
+    for target in TARGETS:
+        for path in (target.repository_path, target.zips_path):
+            if os.path.abspath(path) != os.path.abspath(SOURCE_PATH):
+                output_paths.add(os.path.abspath(path))
+
+    addons = []
+    with profile_phase('list'):
+        for addon in os.listdir(SOURCE_PATH):
+            if addon in IGNORED_ADDONS:
+                continue
+            path = os.path.join(SOURCE_PATH, addon)
+            # skip any file or .svn folder.
+            if is_addon_dir(path) and os.path.abspath(path) not in output_paths:
+                addons.append(addon)
+    return addons
+
+
+class BuildTarget:
+    """
+        Output settings of one repository built from the sources. Without 'targets'
+        in the configuration the top level settings make the only target, otherwise
+        each entry of 'targets' overrides the top level settings for one repository
+        (version rewriting, tagging, compress only and paths) and every target is
+        built in the same pass over the sources.
+    """
+
+    def __init__(self, config):
+        self.name = config.get('name', '')
+
+        self.tag_unofficial_releases = bool(config.get('tag_unofficial_releases'))
+        self.unofficial_compress_only = bool(config.get('compress_only', {})
+                                             .get('unofficial', False))
+        self.python3_compress_only = bool(config.get('compress_only', {}).get('python3', False))
+        self.matrix_build_version = bool(config.get('matrix_build_version'))
+        # addons.xml.md5 is always generated, other hashlib algorithms are optional
+        self.checksums = ['md5'] + [algorithm for algorithm in config.get('checksums', [])
+                                    if algorithm != 'md5']
+        self.retention = RetentionPolicy(config.get('retention', {}))
+        self.index_compression = list(config.get('index_compression', []))
+        for extension in self.index_compression:
+            if extension not in INDEX_COMPRESSORS:
+                raise ValueError('index_compression %s is not supported, use one of: %s' %
+                                 (extension, ', '.join(sorted(INDEX_COMPRESSORS))))
+
+        self.repository_path = config.get('path', {}).get('repository', '')
+        self.zips_path = config.get('path', {}).get('zips', '')
+        if not self.repository_path:
+            self.repository_path = os.getcwd()
+
+        self.build_manifest = config.get('build_manifest', '')
+        if self.build_manifest:
+            self.build_manifest = os.path.join(self.repository_path, self.build_manifest)
+        self.fingerprint = get_config_fingerprint(config)
+        self.manifest = None
+
+    def load_manifest(self):
+        if self.build_manifest:
+            self.manifest = BuildManifest(self.build_manifest, self.fingerprint)
+
+    def save_manifest(self):
+        if self.manifest:
+            self.manifest.save()
+
+
+def get_targets(config):
+    base = dict((key, value) for key, value in config.items() if key != 'targets')
+    targets = config.get('targets', [])
+    if not targets:
+        return [BuildTarget(base)]
+
+    build_targets = []
+    names = set()
+    for target in targets:
+        # targets are keyed by name in the release indexes and manifests,
+        # a shared name would overwrite them
+        name = target.get('name', '')
+        if not name:
+            raise ValueError('every entry of targets needs a name')
+        if name in names:
+            raise ValueError('target name %s is used more than once' % name)
+        names.add(name)
+
+        target_config = dict(base)
+        for key, value in target.items():
+            if isinstance(value, dict) and isinstance(base.get(key), dict):
+                # nested settings like path and compress_only are overridden per key
+                merged = dict(base[key])
+                merged.update(value)
+                value = merged
+            target_config[key] = value
+        build_targets.append(BuildTarget(target_config))
+    return build_targets
+
+
+def build():
+    # build every target in a single pass over the sources
+    for target in TARGETS:
+        target.load_manifest()
+
+    compressor = Compressor()
+    for target in TARGETS:
+        Generator(target, released=compressor.released[target.name])
+        target.save_manifest()
+
+
+def _compress_addon_worker(args):
+    # process pool entry point, one fresh compressor per add-on.
+    # the worker's profile of the add-on is sent back with the result
+    addon, entries = args
+    result = (addon,) + Compressor(auto_run=False).compress_addon(addon, entries)
+    return result + (PROFILE.drain() if PROFILE else None,)
+
+
+def get_config_fingerprint(config):
+    # settings that change the build output, a change invalidates the build manifest
+    config = dict((key, value) for key, value in config.items()
+                  if key not in ('workers', 'force_rebuild', 'build_manifest', 'checksums',
+                                 'index_compression', 'retention', 'watch', 'name',
+                                 'profile'))
+    return hashlib.md5(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_tree_stats(directory):
+    # returns a hash of the relative path, size and mtime of every file,
+    # the newest mtime and the file list. only stats files, contents are not read
+    files = []
+    mtime = 0
+    stats = hashlib.md5()
+    for root, relative_root, filenames in IGNORE_MATCHER.walk(directory):
+        for filename in filenames:
+            full_path = os.path.join(root, filename)
+            relative_path = relative_root + filename
+            stat = os.stat(full_path)
+            mtime = max(mtime, stat.st_mtime)
+            stats.update(('%s\0%d\0%r\0' % (relative_path, stat.st_size,
+                                             stat.st_mtime)).encode('utf-8'))
+            files.append(relative_path)
+    return stats.hexdigest(), mtime, files
+
+
+def get_tree_hash(directory, files):
+    # returns a hash of the relative path and contents of every file
+    tree_hash = hashlib.sha1()
+    with profile_phase('hash', os.path.basename(directory)) as phase:
+        for relative_path in files:
+            tree_hash.update((relative_path + '\0').encode('utf-8'))
+            with open(os.path.join(directory, relative_path), 'rb') as open_file:
+                for chunk in iter(lambda: open_file.read(65536), b''):
+                    tree_hash.update(chunk)
+                    phase.add_bytes(len(chunk))
+            tree_hash.update(b'\0')
+    return tree_hash.hexdigest()
+
+
+def get_worker_count(workers=None):
+    if workers is None:
+        workers = WORKERS
+    if workers < 1:
+        try:
+            workers = multiprocessing.cpu_count()
+        except NotImplementedError:
+            workers = 1
+    return workers
+
+
 def is_py3(addon_xml):
     required = addon_xml.findall('./requires/import')
 
@@ -453,6 +1927,23 @@ def read_file(filename, is_json=False):
                 return open_file.read().decode('utf-8')
 
 
+def remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def replace_file(source, destination):
+    # atomically replace destination with source
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)  # pylint: disable=no-member
+    else:
+        if os.name == 'nt' and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
 def save_file(filename_and_path, contents):
     if isinstance(contents, bytes):
         contents = contents.decode('utf-8')
@@ -488,30 +1979,53 @@ def split_version(v):
     return filled
 
 
-if __name__ == '__main__':
-    CONFIG = read_file('.config.json', is_json=True)
+def load_config(config):
+    # pylint: disable=global-statement
+    global CONFIG, COMPRESS_ADDONS, WORKERS, COMPRESSION_POLICY, FORCE_REBUILD, \
+        IGNORED_ADDONS, IGNORE_MATCHER, SOURCE_PATH, TARGETS, PROFILE
+
+    CONFIG = config
 
     COMPRESS_ADDONS = bool(CONFIG.get('compress_addons'))
+    WORKERS = int(CONFIG.get('workers', 1) or 0)
+    COMPRESSION_POLICY = CompressionPolicy(CONFIG.get('compression', {}))
+    FORCE_REBUILD = bool(CONFIG.get('force_rebuild'))
 
-    TAG_UNOFFICIAL_RELEASES = bool(CONFIG.get('tag_unofficial_releases'))
-    UNOFFICIAL_COMPRESS_ONLY = bool(CONFIG.get('compress_only', {}).get('unofficial', False))
-    PYTHON3_COMPRESS_ONLY = bool(CONFIG.get('compress_only', {}).get('python3', False))
-    MATRIX_BUILD_VERSION = bool(CONFIG.get('matrix_build_version'))
     IGNORED_ADDONS = list(set(CONFIG.get('ignored', {}).get('addons', [])))
-    IGNORED_FILES = list(set(CONFIG.get('ignored', {}).get('files', [])))
-    IGNORED_FILES_START = tuple(set(CONFIG.get('ignored', {}).get('file_starts_with', [])))
-    IGNORED_FILES_END = tuple(set(CONFIG.get('ignored', {}).get('file_ends_with', [])))
-    IGNORED_DIRECTORIES = list(set(CONFIG.get('ignored', {}).get('directories', [])))
+    IGNORE_MATCHER = IgnoreMatcher(CONFIG.get('ignored', {}))
 
     SOURCE_PATH = CONFIG.get('path', {}).get('source', '')
-    REPOSITORY_PATH = CONFIG.get('path', {}).get('repository', '')
-    ZIPS_PATH = CONFIG.get('path', {}).get('zips', '')
-
-    if not REPOSITORY_PATH:
-        REPOSITORY_PATH = os.getcwd()
     if not SOURCE_PATH:
         SOURCE_PATH = os.getcwd()
 
+    TARGETS = get_targets(CONFIG)
+
+    PROFILE = BuildProfile() if CONFIG.get('profile') else None
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(prog=__script__)
+    PARSER.add_argument('--force', action='store_true',
+                        help='rebuild every add-on, ignoring the build manifest')
+    PARSER.add_argument('--watch', action='store_true',
+                        help='keep running and rebuild add-ons as their source changes')
+    PARSER.add_argument('--verify', action='store_true',
+                        help='check the built zips, addons.xml and checksum files, '
+                             'exits with 1 if anything doesn\'t match')
+    PARSER.add_argument('--profile', action='store_true',
+                        help='print the time and bytes spent on each add-on and build phase')
+    PARSER.add_argument('--profile-output', metavar='FILE',
+                        help='write the profile to FILE, as JSON if it ends in .json or as '
+                             'a cProfile dump of the main process otherwise')
+    ARGS = PARSER.parse_args()
+
+    LOADED_CONFIG = read_file('.config.json', is_json=True)
+    if ARGS.force:
+        LOADED_CONFIG['force_rebuild'] = True
+    if ARGS.profile or ARGS.profile_output:
+        LOADED_CONFIG['profile'] = True
+    load_config(LOADED_CONFIG)
+
     print(__script__)
     print('Version: v' + str(__revision__))
     print('License:  ' + __license__)
@@ -521,22 +2035,52 @@ if __name__ == '__main__':
 
     print('Paths:')
     print('    Source:     ' + SOURCE_PATH)
-    print('    Repository: ' + REPOSITORY_PATH)
-    print('    Zips:       ' + ZIPS_PATH)
     print(' ')
 
     print('Compress Add-ons:       ' + str(COMPRESS_ADDONS))
+    print('Workers:                ' + str(get_worker_count()))
+    print('Force Rebuild:          ' + str(FORCE_REBUILD))
     print(' ')
 
-    print('Unofficial:')
-    print('    Tagged: ' + str(TAG_UNOFFICIAL_RELEASES))
-    print('    Compress Only: ' + str(UNOFFICIAL_COMPRESS_ONLY))
-    print(' ')
-
-    print('Python 3:')
-    print('    Compress Only: ' + str(PYTHON3_COMPRESS_ONLY))
-    print('    Build Version (x.x.x+matrix.1): ' + str(MATRIX_BUILD_VERSION))
-    print(' ')
+    for TARGET in TARGETS:
+        if TARGET.name:
+            print('Target: ' + TARGET.name)
+        print('    Repository: ' + TARGET.repository_path)
+        print('    Zips:       ' + TARGET.zips_path)
+        print('    Build Manifest: ' + (TARGET.build_manifest or 'disabled'))
+        print('    Checksums: ' + ', '.join(TARGET.checksums))
+        print('    Index Compression: ' + (', '.join(TARGET.index_compression) or 'disabled'))
+        print('    Retention: ' + str(TARGET.retention))
+        print('    Unofficial:')
+        print('        Tagged: ' + str(TARGET.tag_unofficial_releases))
+        print('        Compress Only: ' + str(TARGET.unofficial_compress_only))
+        print('    Python 3:')
+        print('        Compress Only: ' + str(TARGET.python3_compress_only))
+        print('        Build Version (x.x.x+matrix.1): ' + str(TARGET.matrix_build_version))
+        print(' ')
+
+    PROFILER = None
+    if ARGS.profile_output and not ARGS.profile_output.endswith('.json'):
+        PROFILER = cProfile.Profile()
+        PROFILER.enable()
 
-    Compressor()
-    Generator()
+    try:
+        if ARGS.verify:
+            VERIFIED = Verifier().run()
+        elif ARGS.watch:
+            for TARGET in TARGETS:
+                TARGET.load_manifest()
+            Watcher().run()
+        else:
+            build()
+    finally:
+        if PROFILER:
+            PROFILER.disable()
+            PROFILER.dump_stats(ARGS.profile_output)
+        if PROFILE:
+            PROFILE.report()
+            if ARGS.profile_output and ARGS.profile_output.endswith('.json'):
+                PROFILE.save(ARGS.profile_output)
+
+    if ARGS.verify and not VERIFIED:
+        sys.exit(1)
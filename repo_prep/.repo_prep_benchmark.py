@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for .repo_prep.py
+
+Generates a synthetic repository and times the Compressor and Generator end to
+end, and per phase (walk, read, compress, hash, write), for a cold build, a
+no-op rebuild and a rebuild after touching and changing a few add-ons.
+Results are saved as JSON and can be compared with a previous run.
+
+Python 2.7 -> 3.7, runs offline, only needs lxml like .repo_prep.py
+
+usage:
+    python .repo_prep_benchmark.py --addons 150 --files 40 --file-size 8192 \\
+        --assets 4 --asset-size 262144 --workers 0 --output results.json
+    python .repo_prep_benchmark.py --compare results.json
+
+Per phase times are exclusive, ie. time spent walking inside recursive_zipper is
+counted as walk and not as compress. Phases are only recorded in the main process,
+use --workers 1 (the default) to get a complete per phase breakdown.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+__script__ = '.repo_prep_benchmark.py'
+
+PHASES = ['walk', 'read', 'compress', 'hash', 'write']
+
+TIMER = getattr(time, 'perf_counter', time.time)
+
+ADDON_XML = u'''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<addon id="%(addon_id)s" name="Benchmark %(index)d" version="%(version)s" provider-name="benchmark">
+  <requires>
+    <import addon="xbmc.python" version="%(python)s"/>
+  </requires>
+  <extension point="xbmc.python.pluginsource" library="default.py">
+    <provides>video</provides>
+  </extension>
+  <extension point="xbmc.addon.metadata">
+    <summary lang="en_GB">Synthetic add-on %(index)d</summary>
+    <description lang="en_GB">Generated by %(script)s</description>
+    <license>GPL-3.0-only</license>
+    <assets>
+      <icon>resources/media/icon.png</icon>
+      <fanart>resources/media/fanart.jpg</fanart>
+    </assets>
+  </extension>
+</addon>
+'''
+
+WORDS = ['import', 'def', 'return', 'self', 'xbmc', 'addon', 'path', 'url', 'item',
+         'list', 'settings', 'cache', 'value', 'None', 'True', 'False', 'for', 'in']
+
+
+def load_repo_prep(path):
+    # load .repo_prep.py as a module named repo_prep, pool workers pickle functions by module name
+    if sys.version_info >= (3, 5):
+        import importlib.util  # pylint: disable=import-outside-toplevel
+        spec = importlib.util.spec_from_file_location('repo_prep', path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['repo_prep'] = module
+        spec.loader.exec_module(module)
+    else:
+        import imp  # pylint: disable=import-outside-toplevel
+        module = imp.load_source('repo_prep', path)
+    return module
+
+
+def write_text_file(filename, size, rng):
+    lines = []
+    length = 0
+    while length < size:
+        line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        lines.append(line)
+        length += len(line) + 1
+    with open(filename, 'wb') as open_file:
+        open_file.write(('\n'.join(lines)[:size]).encode('utf-8'))
+
+
+def write_binary_file(filename, size):
+    with open(filename, 'wb') as open_file:
+        open_file.write(os.urandom(size))
+
+
+def generate_repository(root, args):
+    rng = random.Random(args.seed)
+    source_path = os.path.join(root, 'source')
+
+    for index in range(args.addons):
+        addon_id = 'plugin.video.benchmark%04d' % index
+        addon_path = os.path.join(source_path, addon_id)
+        os.makedirs(os.path.join(addon_path, 'resources', 'lib'))
+        os.makedirs(os.path.join(addon_path, 'resources', 'media'))
+        os.makedirs(os.path.join(addon_path, '.git', 'objects'))
+
+        with open(os.path.join(addon_path, 'addon.xml'), 'wb') as open_file:
+            open_file.write((ADDON_XML % {
+                'addon_id': addon_id,
+                'index': index,
+                'version': '1.0.%d' % index,
+                'python': '3.0.0' if index % 2 else '2.25.0',
+                'script': __script__,
+            }).encode('utf-8'))
+        write_text_file(os.path.join(addon_path, 'changelog.txt'), 512, rng)
+        write_text_file(os.path.join(addon_path, 'default.py'), args.file_size, rng)
+
+        for file_index in range(args.files):
+            write_text_file(os.path.join(addon_path, 'resources', 'lib',
+                                         'module%03d.py' % file_index), args.file_size, rng)
+
+        write_binary_file(os.path.join(addon_path, 'resources', 'media', 'icon.png'),
+                          args.asset_size)
+        write_binary_file(os.path.join(addon_path, 'resources', 'media', 'fanart.jpg'),
+                          args.asset_size)
+        for asset_index in range(args.assets):
+            write_binary_file(os.path.join(addon_path, 'resources', 'media',
+                                           'screenshot%02d.jpg' % asset_index), args.asset_size)
+
+        # history the build should never look at
+        for git_index in range(args.git_objects):
+            write_binary_file(os.path.join(addon_path, '.git', 'objects',
+                                           'object%04d' % git_index), 1024)
+
+    return source_path
+
+
+def get_config(root, source_path, args):
+    config_file = args.config or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                              '.config.json')
+    with open(config_file, 'r') as open_file:
+        config = json.load(open_file)
+
+    repository_path = os.path.join(root, 'repository')
+    zips_path = os.path.join(repository_path, 'zips')
+    os.makedirs(zips_path)
+
+    config['compress_addons'] = True
+    config['workers'] = args.workers
+    config['path'] = {
+        'source': source_path,
+        'repository': repository_path,
+        'zips': zips_path,
+    }
+    return config
+
+
+class PhaseTimer:
+    """
+        Wraps repo_prep functions and records exclusive wall time per phase
+    """
+
+    def __init__(self):
+        self.stack = []
+        self.totals = dict((phase, 0.0) for phase in PHASES)
+
+    def reset(self):
+        self.stack = []
+        self.totals = dict((phase, 0.0) for phase in PHASES)
+
+    def _enter(self, phase):
+        self.stack.append([phase, TIMER(), 0.0])
+
+    def _exit(self):
+        phase, started, children = self.stack.pop()
+        elapsed = TIMER() - started
+        self.totals[phase] += elapsed - children
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def wrap_function(self, function, phase):
+        def wrapper(*args, **kwargs):
+            self._enter(phase)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._exit()
+
+        return wrapper
+
+    def wrap_generator(self, function, phase):
+        # only the time spent producing each item is counted
+        def wrapper(*args, **kwargs):
+            iterator = iter(function(*args, **kwargs))
+            while True:
+                self._enter(phase)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self._exit()
+                yield item
+
+        return wrapper
+
+    def install(self, module):
+        module.IgnoreMatcher.walk = self.wrap_generator(module.IgnoreMatcher.walk, 'walk')
+        module.read_file = self.wrap_function(module.read_file, 'read')
+        module.AddonMetadata.__init__ = self.wrap_function(module.AddonMetadata.__init__,
+                                                           'read')
+        module.Compressor.recursive_zipper = \
+            self.wrap_function(module.Compressor.recursive_zipper, 'compress')
+        module.get_tree_hash = self.wrap_function(module.get_tree_hash, 'hash')
+        module.Compressor.create_compressed_addon_release = \
+            self.wrap_function(module.Compressor.create_compressed_addon_release, 'write')
+        module.Generator._write_addons_xml = \
+            self.wrap_function(module.Generator._write_addons_xml, 'write')
+
+
+class Silenced:
+    """
+        Swallows the output of repo_prep while it is being timed
+    """
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def run_build(module, config, timer):
+    timer.reset()
+    module.load_config(config)
+    with Silenced():
+        started = TIMER()
+        for target in module.TARGETS:
+            target.load_manifest()
+        compressor = module.Compressor()
+        compressed = TIMER()
+        for target in module.TARGETS:
+            module.Generator(target, released=compressor.released[target.name])
+            target.save_manifest()
+        finished = TIMER()
+
+    return {
+        'total': finished - started,
+        'compressor': compressed - started,
+        'generator': finished - compressed,
+        'phases': dict(timer.totals),
+    }
+
+
+def modify_addons(source_path, count):
+    # touch one file and change the contents of another in the first count add-ons
+    addons = sorted(os.listdir(source_path))[:count]
+    for addon in addons:
+        os.utime(os.path.join(source_path, addon, 'default.py'), None)
+        with open(os.path.join(source_path, addon, 'resources', 'lib', 'module000.py'),
+                  'ab') as open_file:
+            open_file.write(b'\n# modified\n')
+
+
+def get_directory_size(directory):
+    size = 0
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
+
+
+def benchmark(args):
+    module = load_repo_prep(args.script)
+    timer = PhaseTimer()
+    timer.install(module)
+
+    results = {
+        'script': os.path.basename(args.script),
+        'revision': module.__revision__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': module.multiprocessing.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': dict((key, value) for key, value in vars(args).items()
+                           if key not in ('output', 'compare', 'keep')),
+        'runs': [],
+    }
+
+    for repeat in range(args.repeat):
+        root = tempfile.mkdtemp(prefix='repo_prep_benchmark_')
+        try:
+            generation_started = TIMER()
+            source_path = generate_repository(root, args)
+            config = get_config(root, source_path, args)
+            generation_time = TIMER() - generation_started
+            source_size = get_directory_size(source_path)
+
+            scenarios = [('cold', None), ('noop', None), ('modified', args.modified)]
+            for scenario, modified in scenarios:
+                if modified:
+                    modify_addons(source_path, modified)
+                run = run_build(module, config, timer)
+                run.update({
+                    'scenario': scenario,
+                    'repeat': repeat,
+                    'source_bytes': source_size,
+                    'zips_bytes': get_directory_size(config['path']['zips']),
+                    'generation': generation_time,
+                })
+                results['runs'].append(run)
+                print_run(run)
+        finally:
+            if args.keep:
+                print('Kept synthetic repository in %s' % root)
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+
+    return results
+
+
+def summarize(results):
+    # best time of every scenario over all repeats
+    summary = {}
+    for run in results['runs']:
+        best = summary.get(run['scenario'])
+        if best is None or run['total'] < best['total']:
+            summary[run['scenario']] = run
+    return summary
+
+
+def print_run(run):
+    phases = '  '.join('%s %.3fs' % (phase, run['phases'][phase]) for phase in PHASES)
+    print('%-9s total %.3fs  compressor %.3fs  generator %.3fs  |  %s' %
+          (run['scenario'], run['total'], run['compressor'], run['generator'], phases))
+
+
+def print_comparison(previous, current):
+    previous_summary = summarize(previous)
+    current_summary = summarize(current)
+    print(' ')
+    print('Compared with %s (%s):' % (previous.get('revision'), previous.get('timestamp')))
+    for scenario in ('cold', 'noop', 'modified'):
+        if scenario not in previous_summary or scenario not in current_summary:
+            continue
+        before = previous_summary[scenario]['total']
+        after = current_summary[scenario]['total']
+        change = ((after - before) / before * 100.0) if before else 0.0
+        print('%-9s %.3fs -> %.3fs  (%+.1f%%)' % (scenario, before, after, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=__script__)
+    parser.add_argument('--script', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '.repo_prep.py'),
+                        help='path to the .repo_prep.py to benchmark')
+    parser.add_argument('--config', default='',
+                        help='base configuration, defaults to the .config.json next to this script')
+    parser.add_argument('--addons', type=int, default=50, help='number of add-ons')
+    parser.add_argument('--files', type=int, default=20, help='python files per add-on')
+    parser.add_argument('--file-size', type=int, default=4096, help='size of each python file')
+    parser.add_argument('--assets', type=int, default=2,
+                        help='incompressible screenshots per add-on, besides icon and fanart')
+    parser.add_argument('--asset-size', type=int, default=65536,
+                        help='size of each incompressible asset')
+    parser.add_argument('--git-objects', type=int, default=20,
+                        help='files in each add-on\'s .git folder')
+    parser.add_argument('--modified', type=int, default=5,
+                        help='add-ons changed before the last run')
+    parser.add_argument('--workers', type=int, default=1, help='workers setting for the build')
+    parser.add_argument('--repeat', type=int, default=1, help='number of repetitions')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated text files')
+    parser.add_argument('--output', default='repo_prep_benchmark.json',
+                        help='file to save the results to')
+    parser.add_argument('--compare', default='', help='previous results to compare with')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the synthetic repository for inspection')
+    args = parser.parse_args()
+
+    results = benchmark(args)
+
+    with open(args.output, 'w') as open_file:
+        json.dump(results, open_file, indent=2, sort_keys=True)
+    print(' ')
+    print('Results saved to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare, 'r') as open_file:
+            print_comparison(json.load(open_file), results)
+
+
+if __name__ == '__main__':
+    main()
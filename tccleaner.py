@@ -9,6 +9,33 @@
         TextureCacheCleaner().remove_like('http%domain.com/%.jpg')
         # remove all cached items matching sqlite LIKE pattern http%domain.com/%.jpg
 
+        TextureCacheCleaner(vacuum=TextureCacheCleaner.VACUUM_INCREMENTAL).remove_like('http%domain.com/%')
+        # free at most incremental_pages pages after the purge instead of rewriting the whole database
+
+        TextureCacheCleaner().remove_matching(patterns=['http%old-cdn.com/%'], regexes=[r'^https?://img\d+\.cdn\.net/'])
+        # remove the cached items matching any of the patterns in one scan and one transaction
+
+        TextureCacheCleaner().trim(max_bytes=200 * 1024 * 1024, policy='lru')
+        # evict the least recently used cached items until the cached images use at most 200 MB
+
+        TextureCacheCleaner().report_like('http%domain.com/%.jpg')
+        # count the cached items and bytes remove_like would remove, without removing anything
+
+        TextureCacheCleaner().purge_in_background(patterns=['http%domain.com/%'])
+        # remove the cached items in short time-boxed batches that keep Kodi responsive, from a service add-on
+
+        TextureCacheCleaner().reconcile()
+        # delete cached images without a texture row and texture rows without a cached image
+
+        TextureCacheCleaner().remove_host('domain.com')
+        # remove all cached items from domain.com and its subdomains with index lookups instead of a full scan
+
+        TextureCacheCleaner().remove_prefix('https://img.domain.com/posters/')
+        # remove all cached items with urls starting with the prefix (case-sensitive) using Kodi's url index
+
+        TextureCacheCleaner(progress=CallbackProgressReporter(callback)).remove_like('http%domain.com/%')
+        # report progress to callback(percent, message) instead of a progress dialog, NullProgressReporter() for none
+
     Copyright (C) 2016 anxdpanic
 
     This program is free software: you can redistribute it and/or modify
@@ -25,18 +52,211 @@
     along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import hashlib
+import json
 import os
+import re
 import sqlite3
+import threading
+import time
 import xbmc
 import xbmcgui
 import xbmcaddon
 import xbmcvfs
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+
+class EvictionPolicy(object):
+    """
+    Order in which TextureCacheCleaner.trim evicts textures, first row first.
+        Subclasses set order_by, an sql ORDER BY over id, cachedurl, lastusetime (last use of any size)
+        and usecount (uses of all sizes), or override get_query
+    """
+    order_by = 'id'
+
+    def get_query(self):
+        """
+        :return: string: sql query of (id, cachedurl) of every texture in eviction order
+        """
+        return 'SELECT id, cachedurl FROM (' \
+               'SELECT texture.id AS id, texture.cachedurl AS cachedurl, ' \
+               'MAX(sizes.lastusetime) AS lastusetime, SUM(sizes.usecount) AS usecount ' \
+               'FROM texture LEFT JOIN sizes ON sizes.idtexture = texture.id GROUP BY texture.id' \
+               ') ORDER BY ' + self.order_by
+
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Least recently used first
+    """
+    order_by = 'lastusetime, id'
+
+
+class LFUPolicy(EvictionPolicy):
+    """
+    Least frequently used first, least recently used of those used as often
+    """
+    order_by = 'usecount, lastusetime, id'
+
+
+class AgePolicy(EvictionPolicy):
+    """
+    Oldest cached first
+    """
+    order_by = 'id'
+
+
+class ProgressReporter(object):
+    """
+    Reports the progress of a purge, throttled to at most one update every interval seconds
+        and min_step percent. The first update and 100 percent are always reported.
+        Messages are formatted with args only when an update is reported.
+        Subclasses implement open, report and close
+    """
+
+    def __init__(self, interval=0.5, min_step=1):
+        """
+        :param interval: float: minimum seconds between reported updates
+        :param min_step: int: minimum change in percent between reported updates
+        """
+        self.interval = interval
+        self.min_step = min_step
+        self.last_percent = None
+        self.last_time = 0
+
+    def start(self, heading, message=''):
+        self.last_percent = None
+        self.last_time = 0
+        self.open(heading, message)
+
+    def update(self, percent, message=None, *args):
+        """
+        :param percent: int: progress in percent
+        :param message: string: message, formatted with args if it is reported
+        """
+        now = time.time()
+        if self.last_percent is not None and percent < 100:
+            if abs(percent - self.last_percent) < self.min_step or now - self.last_time < self.interval:
+                return
+        self.last_percent = percent
+        self.last_time = now
+        if message is not None and args:
+            message = message.format(*args)
+        self.report(percent, message)
+
+    def open(self, heading, message):
+        pass
+
+    def report(self, percent, message):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullProgressReporter(ProgressReporter):
+    """
+    Reports nothing, for headless and service callers
+    """
+
+    def update(self, percent, message=None, *args):
+        pass
+
+
+class CallbackProgressReporter(ProgressReporter):
+    """
+    Reports progress to callback(percent, message)
+    """
+
+    def __init__(self, callback, interval=0.5, min_step=1):
+        super(CallbackProgressReporter, self).__init__(interval, min_step)
+        self.callback = callback
+
+    def report(self, percent, message):
+        self.callback(percent, message)
+
+
+class DialogProgressReporter(ProgressReporter):
+    """
+    Reports progress in a background progress dialog (xbmcgui.DialogProgressBG)
+    """
+
+    def __init__(self, interval=0.5, min_step=1):
+        super(DialogProgressReporter, self).__init__(interval, min_step)
+        self.dialog = None
+
+    def open(self, heading, message):
+        self.dialog = xbmcgui.DialogProgressBG()
+        self.dialog.create(heading, message)
+
+    def report(self, percent, message):
+        if self.dialog:
+            self.dialog.update(percent, message=message)
+
+    def close(self):
+        if self.dialog:
+            self.dialog.close()
+            self.dialog = None
+
 
 class TextureCacheCleaner(object):
     ICON = xbmc.translatePath('special://home/addons/%s/icon.png' % xbmcaddon.Addon().getAddonInfo('id'))
     NAME = xbmcaddon.Addon().getAddonInfo('name')
     DATABASE = xbmc.translatePath('special://database/Textures13.db')
+    THUMBNAILS = xbmc.translatePath('special://thumbnails/')
+    PURGE_STATE = xbmc.translatePath(xbmcaddon.Addon().getAddonInfo('profile') + 'tccleaner_purge.json')
+    DELETE_THREADS = 8
+    PROGRESS_INTERVAL = 0.5
+    # batches of purge_in_background in a row that may fail because Kodi holds the database
+    BUSY_RETRIES = 20
+
+    VACUUM_NEVER = 'never'
+    VACUUM_ALWAYS = 'always'
+    VACUUM_THRESHOLD = 'threshold'
+    VACUUM_INCREMENTAL = 'incremental'
+
+    AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+    EVICTION_POLICIES = {'lru': LRUPolicy(), 'lfu': LFUPolicy(), 'age': AgePolicy()}
+
+    # folders of special://thumbnails/ that hold the cached images of texture.cachedurl
+    THUMBNAIL_FOLDERS = frozenset('0123456789abcdef')
+    # images modified more recently may belong to a texture row that isn't committed yet
+    ORPHAN_GRACE_PERIOD = 3600
+    # rows of texture copied by each of reconcile's short reads
+    RECONCILE_CHUNK_SIZE = 5000
+
+    # triggers on texture that keep the tccleaner_host index of remove_host up to date
+    HOST_INDEX_TRIGGERS = ('tccleanerHostInsert', 'tccleanerHostUpdate', 'tccleanerHostDelete')
+    # longest host name in tccleaner_host, the triggers reverse hosts one character at a time up to it.
+    # longer 'hosts' are not dns names, like the encoded urls of image://
+    MAX_HOST_LENGTH = 253
+
+    def __init__(self, vacuum=VACUUM_THRESHOLD, free_page_threshold=0.25, incremental_pages=2048, progress=None):
+        """
+        :param vacuum: string: when free space is recovered after a purge, one of
+            VACUUM_NEVER, VACUUM_ALWAYS: full VACUUM after every purge,
+            VACUUM_THRESHOLD: full VACUUM only when the free pages are at least free_page_threshold of the database,
+            VACUUM_INCREMENTAL: PRAGMA incremental_vacuum(incremental_pages), the database is switched
+                to auto_vacuum=INCREMENTAL with a single full VACUUM the first time
+        :param free_page_threshold: float: fraction of free pages that triggers a VACUUM_THRESHOLD vacuum
+        :param incremental_pages: int: maximum number of pages freed by a VACUUM_INCREMENTAL vacuum
+        :param progress: ProgressReporter: reports the progress of removals, None for a progress dialog
+            when notifications are enabled and no progress otherwise (always none in purge_in_background)
+        """
+        self.vacuum = vacuum
+        self.free_page_threshold = free_page_threshold
+        self.incremental_pages = incremental_pages
+        self.progress = progress
 
     def notification(self, message, time=2000, sound=False):
         xbmcgui.Dialog().notification(self.NAME, message, self.ICON, time, sound)
@@ -47,49 +267,500 @@ class TextureCacheCleaner(object):
             from sqlite database(Textures13.db) and deletes cached image
         :param pattern: string: an sqlite LIKE pattern of image url(s) to be removed
         :param notify: bool: enable/disable informational notifications
-        :return:
+        :return: int: number of removed cached items
+        """
+        return self.remove_matching(patterns=[pattern], notify=notify)
+
+    def remove_matching(self, patterns=None, regexes=None, notify=True):
+        """
+        Removes cached items with urls LIKE any of patterns or matching any of regexes
+            from sqlite database(Textures13.db) and deletes cached images,
+            all patterns are matched in a single scan of texture, deleted in one transaction and compacted once
+        :param patterns: list: sqlite LIKE patterns of image url(s) to be removed
+        :param regexes: list: regular expressions of image url(s) to be removed, matched with re.search
+        :param notify: bool: enable/disable informational notifications
+        :return: int: number of removed cached items
+        :raises ValueError: if one of the regexes is not a valid regular expression
+        """
+        where, parameters = self._get_match_clause(patterns, regexes)
+        if not where:
+            return 0
+
+        def select(cursor):
+            cursor.execute('INSERT INTO temp.purge SELECT id, cachedurl FROM texture WHERE ' + where, parameters)
+
+        return self._remove(select, notify)
+
+    def remove_host(self, host, include_subdomains=True, notify=True):
+        """
+        Removes cached items with urls from host from sqlite database(Textures13.db) and deletes cached images.
+            The textures are found in the tccleaner_host index of host to texture id instead of scanning texture,
+            the index is created on first use (one full scan) and kept up to date by triggers, see build_host_index.
+            Hosts longer than MAX_HOST_LENGTH are not indexed
+        :param host: string: host name, or a url of the host, 'domain.com' or 'http://user@domain.com:8080/'
+        :param include_subdomains: bool: also remove cached items from subdomains of host, img.domain.com
+        :param notify: bool: enable/disable informational notifications
+        :return: int: number of removed cached items
+        """
+        host = self._normalize_host(host)
+        if not host or len(host) > self.MAX_HOST_LENGTH:
+            return 0
+
+        indexed_host = self._get_indexed_host(host)
+        if include_subdomains:
+            # 'moc.niamod.' and its subdomains 'moc.niamod.gmi.' sort before 'moc.niamod/', one range scan
+            where, parameters = 'tccleaner_host.host >= ? AND tccleaner_host.host < ?', \
+                                (indexed_host, indexed_host[:-1] + '/')
+        else:
+            where, parameters = 'tccleaner_host.host = ?', (indexed_host,)
+
+        def select(cursor):
+            self._create_host_index(cursor)
+            cursor.execute('INSERT INTO temp.purge SELECT texture.id, texture.cachedurl '
+                           'FROM tccleaner_host JOIN texture ON texture.id = tccleaner_host.idtexture '
+                           'WHERE ' + where, parameters)
+
+        return self._remove(select, notify)
+
+    def remove_prefix(self, prefix, notify=True):
+        """
+        Removes cached items with urls starting with prefix from sqlite database(Textures13.db) and deletes
+            cached images. Unlike a LIKE pattern the prefix is case-sensitive, which lets it be found
+            with a range scan of Kodi's url index (idxTexture) instead of a full scan
+        :param prefix: string: start of the image url(s) to be removed, 'https://img.domain.com/posters/'
+        :param notify: bool: enable/disable informational notifications
+        :return: int: number of removed cached items
+        """
+        if not prefix:
+            return 0
+        # every url starting with prefix sorts at or after prefix and before prefix with its last character incremented
+        upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+        def select(cursor):
+            cursor.execute('INSERT INTO temp.purge SELECT id, cachedurl FROM texture WHERE url >= ? AND url < ?',
+                           (prefix, upper))
+
+        return self._remove(select, notify)
+
+    def build_host_index(self):
+        """
+        Creates the tccleaner_host table of host to texture id used by remove_host, with triggers on texture
+            that keep it up to date as Kodi adds, changes and removes textures. Only sqlite's built-in functions
+            are used by the triggers, so Kodi's own writes keep working. Hosts are stored reversed with a trailing
+            dot, 'img.domain.com' as 'moc.niamod.gmi.', so a domain and its subdomains are one range of the index.
+            Does nothing if the index exists
+        :return: bool: True if the index was created
+        """
+        if not xbmcvfs.exists(self.DATABASE):
+            return False
+        connection = self._connect()
+        cursor = connection.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            created = self._create_host_index(cursor)
+            cursor.execute('COMMIT')
+        except:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+            connection.close()
+        return created
+
+    def drop_host_index(self):
+        """
+        Removes the tccleaner_host table and its triggers from the database
+        """
+        if not xbmcvfs.exists(self.DATABASE):
+            return
+        connection = self._connect()
+        try:
+            connection.executescript('BEGIN IMMEDIATE;' + ''.join('DROP TRIGGER IF EXISTS {0};'.format(trigger)
+                                                                  for trigger in self.HOST_INDEX_TRIGGERS) +
+                                     'DROP TABLE IF EXISTS tccleaner_host; COMMIT;')
+        finally:
+            connection.close()
+
+    def report_like(self, pattern, sample_size=10):
+        """
+        Reports what remove_like(pattern) would remove, without writing anything
+        :param pattern: string: an sqlite LIKE pattern of image url(s)
+        :param sample_size: int: maximum number of urls in the sample
+        :return: dict: count of matching cached items, bytes of their cached images and a sample of their urls
+        """
+        return self.report_matching(patterns=[pattern], sample_size=sample_size)
+
+    def report_matching(self, patterns=None, regexes=None, sample_size=10):
+        """
+        Reports what remove_matching(patterns, regexes) would remove, without writing anything.
+            The matches are streamed from the cursor, memory use doesn't grow with their number
+        :param patterns: list: sqlite LIKE patterns of image url(s)
+        :param regexes: list: regular expressions of image url(s), matched with re.search
+        :param sample_size: int: maximum number of urls in the sample
+        :return: dict: count of matching cached items, bytes of their cached images and a sample of their urls
+        """
+        result = {'count': 0, 'bytes': 0, 'sample': list()}
+        where, parameters = self._get_match_clause(patterns, regexes)
+        if not where or not xbmcvfs.exists(self.DATABASE):
+            return result
+
+        connection = self._connect()
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT url, cachedurl FROM texture WHERE ' + where, parameters)
+            for url, cachedurl in cursor:
+                result['count'] += 1
+                result['bytes'] += self._get_file_size(cachedurl)
+                if len(result['sample']) < sample_size:
+                    result['sample'].append(url)
+        finally:
+            cursor.close()
+            connection.close()
+        return result
+
+    def trim(self, max_bytes=None, max_entries=None, policy='lru', notify=True):
+        """
+        Keeps the texture cache within a budget, evicting textures in the order of policy until
+            the cached images use at most max_bytes on disk and there are at most max_entries textures
+        :param max_bytes: int: maximum size in bytes of the cached images, None for no limit
+        :param max_entries: int: maximum number of cached textures, None for no limit
+        :param policy: string|EvictionPolicy: 'lru', 'lfu', 'age' or an EvictionPolicy
+        :param notify: bool: enable/disable informational notifications
+        :return: dict: entries and bytes (only counted with max_bytes) of the cache before trimming,
+            evicted entries and evicted bytes
+        """
+        if not isinstance(policy, EvictionPolicy):
+            policy = self.EVICTION_POLICIES[policy]
+
+        result = {'entries': 0, 'bytes': 0, 'evicted': 0, 'evicted_bytes': 0}
+        if not xbmcvfs.exists(self.DATABASE) or (max_bytes is None and max_entries is None):
+            return result
+
+        evicted = list()
+        connection = self._connect()
+        cursor = connection.cursor()
+        try:
+            result['entries'] = cursor.execute('SELECT COUNT(*) FROM texture').fetchone()[0]
+            if max_bytes is not None:
+                cursor.execute('SELECT cachedurl FROM texture')
+                result['bytes'] = sum(self._get_file_size(cachedurl) for (cachedurl,) in cursor)
+
+            cursor.execute(policy.get_query())
+            for texture_id, cachedurl in cursor:
+                over_entries = max_entries is not None and result['entries'] - len(evicted) > max_entries
+                over_bytes = max_bytes is not None and result['bytes'] - result['evicted_bytes'] > max_bytes
+                if not over_entries and not over_bytes:
+                    break
+                evicted.append((texture_id, cachedurl))
+                result['evicted_bytes'] += self._get_file_size(cachedurl)
+        finally:
+            cursor.close()
+            connection.close()
+
+        if evicted:
+            result['evicted'] = self._remove(lambda cursor: cursor.executemany('INSERT INTO temp.purge VALUES (?, ?)',
+                                                                               evicted), notify)
+        return result
+
+    def purge_in_background(self, patterns=None, regexes=None, batch_time=0.05, pause=0.1, busy_timeout=1.0,
+                            monitor=None):
         """
+        Removes cached items like remove_matching, in short batches so Kodi's texture loader is not locked out.
+            Each batch removes the matches in a window of texture ids in its own transaction, the window
+            grows or shrinks to keep a batch within batch_time. Between batches the purge yields for pause
+            seconds and stops if Kodi is exiting. Progress is saved after each batch to PURGE_STATE,
+            the same purge started again resumes after the last removed batch.
+            Textures Kodi adds during the purge are scanned too, until a batch reaches the highest id.
+            The vacuum policy is not applied, a full VACUUM would lock Kodi out for the whole rewrite,
+            free pages are only recovered with PRAGMA incremental_vacuum when the database uses auto_vacuum=INCREMENTAL.
+            Progress is reported after each batch to the progress reporter, None reports nothing
+        :param patterns: list: sqlite LIKE patterns of image url(s) to be removed
+        :param regexes: list: regular expressions of image url(s) to be removed, matched with re.search
+        :param batch_time: float: target duration of a batch in seconds
+        :param pause: float: seconds to yield between batches
+        :param busy_timeout: float: seconds to wait for the database when Kodi is writing to it
+        :param monitor: xbmc.Monitor: monitor used to wait between batches, one is created if None
+        :return: dict: removed count and completed, False if the purge was interrupted or the database
+            stayed busy for BUSY_RETRIES batches in a row
+        :raises sqlite3.OperationalError: if a batch fails for another reason than a busy database
+        """
+        result = {'removed': 0, 'completed': False}
+        where, parameters = self._get_match_clause(patterns, regexes)
+        if not where or not xbmcvfs.exists(self.DATABASE):
+            return result
+
+        monitor = monitor or xbmc.Monitor()
+        key = hashlib.md5(json.dumps([where, parameters]).encode('utf-8')).hexdigest()
+        state = self._read_purge_state()
+        last_id = state.get('last_id', 0) if state.get('key') == key else 0
+        window = 1000
+        busy_failures = 0
+
+        progress = self.progress or NullProgressReporter()
+        progress.start(self.NAME + ' Cache Removal', 'Removing cached items in the background ...')
+        connection = self._connect(busy_timeout)
+        cursor = connection.cursor()
+        try:
+            # in WAL mode Kodi keeps reading while a batch is written, checkpoint passively after each batch
+            wal = cursor.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal'
+            max_id = cursor.execute('SELECT MAX(id) FROM texture').fetchone()[0] or 0
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS purge (id INTEGER PRIMARY KEY, cachedurl TEXT)')
+
+            while True:
+                if last_id >= max_id:
+                    # textures added since the purge started get ids after max_id
+                    max_id = cursor.execute('SELECT MAX(id) FROM texture').fetchone()[0] or 0
+                    if last_id >= max_id:
+                        break
+                started = time.time()
+                thumbnails = list()
+                try:
+                    cursor.execute('BEGIN IMMEDIATE')
+                    cursor.execute('DELETE FROM temp.purge')
+                    cursor.execute('INSERT INTO temp.purge SELECT id, cachedurl FROM texture '
+                                   'WHERE id > ? AND id <= ? AND (' + where + ')',
+                                   (last_id, last_id + window) + parameters)
+                    cursor.execute('DELETE FROM sizes WHERE idtexture IN (SELECT id FROM temp.purge)')
+                    cursor.execute('DELETE FROM texture WHERE id IN (SELECT id FROM temp.purge)')
+                    cursor.execute('SELECT cachedurl FROM temp.purge')
+                    for (cachedurl,) in cursor:
+                        thumbnails.append(os.path.join(self.THUMBNAILS, cachedurl))
+                    cursor.execute('COMMIT')
+                except sqlite3.OperationalError as error:
+                    xbmc.log('{0}: Background purge batch failed |{1}|'.format(self.NAME, error), xbmc.LOGDEBUG)
+                    try:
+                        cursor.execute('ROLLBACK')
+                    except sqlite3.OperationalError:
+                        # the batch failed to begin, there is no transaction
+                        pass
+                    if not self._is_busy_error(error):
+                        # read-only, full or failing database, retrying won't help
+                        raise
+                    # Kodi held the database longer than busy_timeout, retry a smaller batch after a pause
+                    busy_failures += 1
+                    if busy_failures >= self.BUSY_RETRIES:
+                        xbmc.log('{0}: Background purge stopped, the database was busy for {1} batches in a row'
+                                 .format(self.NAME, busy_failures), xbmc.LOGWARNING)
+                        return result
+                    window = max(window // 2, 1)
+                    if monitor.waitForAbort(pause):
+                        return result
+                    continue
+
+                busy_failures = 0
+
+                last_id += window
+                result['removed'] += len(thumbnails)
+                self._write_purge_state({'key': key, 'last_id': last_id})
+                if wal:
+                    cursor.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+                if thumbnails:
+                    self.delete_thumbnails(thumbnails)
+
+                elapsed = time.time() - started
+                if elapsed < batch_time / 2:
+                    window *= 2
+                elif elapsed > batch_time:
+                    window = max(window // 2, 1)
+                # 100 percent is only reported once no textures were added during the purge
+                progress.update(min(int(last_id * 100 / max_id), 99), 'Removed {0} cached items ...',
+                                result['removed'])
+                if monitor.waitForAbort(pause):
+                    return result
+
+            result['completed'] = True
+            self._write_purge_state(None)
+            if self.get_free_page_stats(cursor)['auto_vacuum'] == 'incremental':
+                self.compact(cursor, self.VACUUM_INCREMENTAL)
+            progress.update(100, 'Removed {0} cached items', result['removed'])
+        finally:
+            cursor.close()
+            connection.close()
+            progress.close()
+        return result
+
+    @staticmethod
+    def _is_busy_error(error):
+        """
+        :return: bool: True if error is sqlite's 'database is locked' or 'database table is locked'
+        """
+        message = str(error)
+        return message.startswith('database is locked') or message.startswith('database table is locked')
+
+    def _read_purge_state(self):
+        try:
+            with open(self.PURGE_STATE, 'r') as state_file:
+                return json.load(state_file)
+        except (IOError, OSError, ValueError):
+            return dict()
+
+    def _write_purge_state(self, state):
+        if state is None:
+            if os.path.exists(self.PURGE_STATE):
+                os.remove(self.PURGE_STATE)
+            return
+        folder = os.path.dirname(self.PURGE_STATE)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(self.PURGE_STATE, 'w') as state_file:
+            json.dump(state, state_file)
+
+    def reconcile(self, dry_run=False, notify=True):
+        """
+        Removes cached images that have no texture row and texture rows whose cached image is missing.
+            The thumbnail folders and texture.cachedurl are streamed side by side in sorted order,
+            so neither is loaded fully into memory. texture is copied in short chunks, Kodi can write between them
+        :param dry_run: bool: only count the orphaned images and missing images, nothing is removed
+        :param notify: bool: enable/disable informational notifications
+        :return: dict: orphaned_files, orphaned_bytes and missing_files (texture rows without a cached image)
+        """
+        result = {'orphaned_files': 0, 'orphaned_bytes': 0, 'missing_files': 0}
+        if not xbmcvfs.exists(self.DATABASE):
+            return result
+
+        orphaned = list()
+        missing = list()
+        grace_time = time.time() - self.ORPHAN_GRACE_PERIOD
+        connection = self._connect()
+        try:
+            files = self._walk_thumbnails()
+            next_file = next(files, None)
+            previous = None
+            for texture_id, cachedurl in self._read_cachedurls(connection):
+                if cachedurl == previous or cachedurl.split('/', 1)[0] not in self.THUMBNAIL_FOLDERS:
+                    continue
+                previous = cachedurl
+                while next_file is not None and next_file < cachedurl:
+                    orphaned.append(next_file)
+                    next_file = next(files, None)
+                if next_file == cachedurl:
+                    next_file = next(files, None)
+                else:
+                    missing.append((texture_id, cachedurl))
+            while next_file is not None:
+                orphaned.append(next_file)
+                next_file = next(files, None)
+        finally:
+            connection.close()
+
+        thumbnails = list()
+        for relative_path in orphaned:
+            path = os.path.join(self.THUMBNAILS, relative_path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.st_mtime < grace_time:
+                thumbnails.append(path)
+                result['orphaned_bytes'] += stat.st_size
+        result['orphaned_files'] = len(thumbnails)
+        result['missing_files'] = len(missing)
+        xbmc.log('{0}: {1} orphaned cached images ({2} bytes), {3} cached items without an image'
+                 .format(self.NAME, result['orphaned_files'], result['orphaned_bytes'], result['missing_files']),
+                 xbmc.LOGDEBUG)
+        if dry_run:
+            return result
+
+        if missing:
+            self._remove(lambda cursor: cursor.executemany('INSERT INTO temp.purge VALUES (?, ?)', missing), notify)
+        if thumbnails:
+            _, failed = self.delete_thumbnails(thumbnails)
+            result['orphaned_files'] -= len(failed)
+        if notify:
+            self.notification('Removed {0} orphaned images and {1} missing cached items'
+                              .format(result['orphaned_files'], result['missing_files']))
+        return result
+
+    def _read_cachedurls(self, connection):
+        """
+        Yields (id, cachedurl) of every texture ordered by cachedurl. texture has no index on cachedurl,
+            so it is copied to a temp table RECONCILE_CHUNK_SIZE rows at a time in id order, each chunk
+            a separate short read with no lock held on the database between chunks, and sorted by
+            the temp table's own index
+        """
+        connection.execute('DROP TABLE IF EXISTS temp.reconcile')
+        connection.execute('CREATE TEMP TABLE reconcile (id INTEGER PRIMARY KEY, cachedurl TEXT NOT NULL)')
+        last_id = 0
+        while True:
+            copied = connection.execute('INSERT INTO temp.reconcile SELECT id, cachedurl FROM texture '
+                                        'WHERE id > ? AND cachedurl IS NOT NULL ORDER BY id LIMIT ?',
+                                        (last_id, self.RECONCILE_CHUNK_SIZE)).rowcount
+            if copied < self.RECONCILE_CHUNK_SIZE:
+                break
+            last_id = connection.execute('SELECT MAX(id) FROM temp.reconcile').fetchone()[0]
+
+        connection.execute('CREATE INDEX temp.idxReconcile ON reconcile(cachedurl)')
+        for row in connection.execute('SELECT id, cachedurl FROM temp.reconcile ORDER BY cachedurl'):
+            yield row
+        connection.execute('DROP TABLE temp.reconcile')
+
+    def _walk_thumbnails(self, relative_path=''):
+        """
+        Yields the paths of the cached images relative to special://thumbnails/ ('a/abcdef01.jpg'),
+            in the same order as sqlite sorts texture.cachedurl
+        """
+        path = os.path.join(self.THUMBNAILS, relative_path)
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return
+
+        entries = list()
+        for name in names:
+            is_folder = os.path.isdir(os.path.join(path, name))
+            if not relative_path and (not is_folder or name not in self.THUMBNAIL_FOLDERS):
+                continue
+            # a folder sorts as its contents do, 'a/...' sorts after 'a.jpg' and 'a-b/...'
+            entries.append((name + '/' if is_folder else name, is_folder))
+
+        for name, is_folder in sorted(entries):
+            if is_folder:
+                for child in self._walk_thumbnails(relative_path + name):
+                    yield child
+            else:
+                yield relative_path + name
+
+    def _remove(self, select, notify=True):
+        """
+        Removes the textures select adds to temp.purge (id, cachedurl) in one transaction,
+            compacts the database and deletes their cached images
+        :param select: callable: called with the cursor inside the transaction to fill temp.purge
+        :param notify: bool: enable/disable informational notifications
+        :return: int: number of removed textures
+        """
+        row_count = 0
         if xbmcvfs.exists(self.DATABASE):
-            connection = sqlite3.connect(self.DATABASE)
-            connection.isolation_level = None
+            connection = self._connect()
             cursor = connection.cursor()
-            dialog = None
             thumbnails = list()
-            if notify:
-                dialog = xbmcgui.DialogProgressBG()
-                dialog.create(self.NAME + ' Cache Removal', 'Removing cached items ...')
+            progress = self.progress or (DialogProgressReporter(self.PROGRESS_INTERVAL) if notify
+                                         else NullProgressReporter())
+            progress.start(self.NAME + ' Cache Removal', 'Removing cached items ...')
             try:
                 cursor.execute('BEGIN')
-                cursor.execute('SELECT id, cachedurl FROM texture WHERE url LIKE "{0}"'.format(pattern))
-                rows_list = cursor.fetchall()
-                row_count = len(rows_list)
-                percent = 100 / (row_count + 5)
+                # collect the textures once, then delete them set-based by id
+                cursor.execute('CREATE TEMP TABLE IF NOT EXISTS purge (id INTEGER PRIMARY KEY, cachedurl TEXT)')
+                cursor.execute('DELETE FROM temp.purge')
+                select(cursor)
+                row_count = cursor.execute('SELECT COUNT(*) FROM temp.purge').fetchone()[0]
                 if row_count > 0:
-                    for index, row in enumerate(rows_list):
-                        if dialog:
-                            dialog.update(percent * (index + 1), message='Removing cached item ... {0}'.format(row[1]))
-                        thumbnail_path = xbmc.translatePath("special://thumbnails/{0}".format(row[1]))
-                        cursor.execute('DELETE FROM sizes WHERE idtexture LIKE "{0}"'.format(row[0]))
-                        if xbmcvfs.exists(thumbnail_path):
-                            thumbnails.append(thumbnail_path)
-                    if dialog:
-                        dialog.update(percent * (row_count + 1), message='Removing cached items from texture ...')
-                    cursor.execute('DELETE FROM texture WHERE url LIKE "{0}"'.format(pattern))
-                if dialog:
-                    dialog.update(percent * (row_count + 2), message='Committing ...')
-                    cursor.execute('COMMIT')
-                    dialog.update(percent * (row_count + 3), message='Recovering free space ...')
-                    cursor.execute('VACUUM')
-                    dialog.update(percent * (row_count + 4), message='Committing ...')
-                    connection.commit()
-                    dialog.update(100, message='Cached items removed')
-                else:
-                    cursor.execute('COMMIT')
-                    cursor.execute('VACUUM')
-                    connection.commit()
+                    progress.update(20, 'Removing {0} cached items from sizes ...', row_count)
+                    cursor.execute('DELETE FROM sizes WHERE idtexture IN (SELECT id FROM temp.purge)')
+                    progress.update(40, 'Removing {0} cached items from texture ...', row_count)
+                    cursor.execute('DELETE FROM texture WHERE id IN (SELECT id FROM temp.purge)')
+                    cursor.execute('SELECT cachedurl FROM temp.purge')
+                    for (cachedurl,) in cursor:
+                        thumbnails.append(os.path.join(self.THUMBNAILS, cachedurl))
+                cursor.execute('DROP TABLE temp.purge')
+                progress.update(60, 'Committing ...')
+                cursor.execute('COMMIT')
+                progress.update(70, 'Recovering free space ...')
+                self.compact(cursor)
+                connection.commit()
+                progress.update(100, 'Cached items removed')
             except:
-                if dialog:
-                    dialog.close()
+                progress.close()
+                row_count = 0
                 thumbnails = list()
                 message = 'Error removing cached items, rolling back ...'
                 self.notification(message, sound=True)
@@ -99,21 +770,292 @@ class TextureCacheCleaner(object):
                 cursor.close()
                 connection.close()
                 if thumbnails:
-                    percent = 100 / len(thumbnails)
-                    for index, thumb in enumerate(thumbnails):
-                        if dialog:
-                            dialog.update(percent * (index + 1), message='Deleting cached item ... {0}'.format(thumb))
-                        try:
-                            xbmcvfs.delete(thumb)
-                        except:
-                            try:
-                                os.remove(thumb)
-                            except:
-                                message = 'Failed to delete |{0}|'.format(thumb)
-                                xbmc.log(message, xbmc.LOGERROR)
-                if dialog:
-                    dialog.close()
+                    _, failed = self.delete_thumbnails(
+                        thumbnails, lambda percent, count: progress.update(percent, 'Deleting cached items ... {0}/{1}',
+                                                                           count, len(thumbnails)))
+                    if failed and notify:
+                        self.notification('Failed to delete {0} of {1} cached images'.format(len(failed), len(thumbnails)),
+                                          sound=True)
+                progress.close()
         else:
             message = 'Database not found ({0})'.format(self.DATABASE)
             self.notification(message)
             xbmc.log(message, xbmc.LOGDEBUG)
+        return row_count
+
+    def _create_host_index(self, cursor):
+        """
+        Creates and fills the tccleaner_host index inside the caller's transaction, if it doesn't exist
+            or its triggers differ from the current ones
+        :return: bool: True if the index was created
+        """
+        triggers = self._get_host_index_triggers()
+        cursor.execute('SELECT name, sql FROM sqlite_master WHERE type = \'trigger\' AND name IN ({0})'
+                       .format(', '.join('?' for _ in self.HOST_INDEX_TRIGGERS)), self.HOST_INDEX_TRIGGERS)
+        if dict(cursor.fetchall()) == triggers:
+            return False
+
+        xbmc.log('{0}: Creating host index of texture'.format(self.NAME), xbmc.LOGDEBUG)
+        for trigger in self.HOST_INDEX_TRIGGERS:
+            cursor.execute('DROP TRIGGER IF EXISTS ' + trigger)
+        cursor.execute('DROP TABLE IF EXISTS tccleaner_host')
+        cursor.execute('CREATE TABLE tccleaner_host (idtexture INTEGER PRIMARY KEY, host TEXT NOT NULL)')
+        cursor.execute('CREATE INDEX idxTCCleanerHost ON tccleaner_host(host)')
+        for trigger in self.HOST_INDEX_TRIGGERS:
+            cursor.execute(triggers[trigger])
+        cursor.execute('INSERT INTO tccleaner_host SELECT id, {0} FROM texture '
+                       'WHERE instr(url, \'://\') > 0 AND length({0}) <= {1:d}'
+                       .format(self._get_host_sql('url'), self.MAX_HOST_LENGTH))
+        cursor.execute('UPDATE tccleaner_host SET host = ' + self._get_reversed_host_sql('host'))
+        return True
+
+    def _get_host_index_triggers(self):
+        """
+        :return: dict: trigger name to the CREATE TRIGGER statement of the tccleaner_host index
+        """
+        # the host of new.url is stored, when it has one that is indexed, and then reversed in place,
+        # reversing the stored column is far cheaper than reversing the host expression
+        insert = 'DELETE FROM tccleaner_host WHERE idtexture = new.id; ' \
+                 'INSERT INTO tccleaner_host SELECT new.id, {0} ' \
+                 'WHERE instr(new.url, \'://\') > 0 AND length({0}) <= {1:d}; ' \
+                 'UPDATE tccleaner_host SET host = {2} WHERE idtexture = new.id; ' \
+            .format(self._get_host_sql('new.url'), self.MAX_HOST_LENGTH, self._get_reversed_host_sql('host'))
+        return {
+            'tccleanerHostInsert': 'CREATE TRIGGER tccleanerHostInsert AFTER INSERT ON texture BEGIN '
+                                   '{0}END'.format(insert),
+            'tccleanerHostUpdate': 'CREATE TRIGGER tccleanerHostUpdate AFTER UPDATE OF id, url ON texture BEGIN '
+                                   'DELETE FROM tccleaner_host WHERE idtexture = old.id; '
+                                   '{0}END'.format(insert),
+            'tccleanerHostDelete': 'CREATE TRIGGER tccleanerHostDelete AFTER DELETE ON texture BEGIN '
+                                   'DELETE FROM tccleaner_host WHERE idtexture = old.id; '
+                                   'END',
+        }
+
+    @classmethod
+    def _get_reversed_host_sql(cls, host):
+        """
+        :return: string: sql expression of host reversed with a trailing dot using only built-in functions,
+            as _get_indexed_host. substr past the end of host is '', short hosts take a shorter chain of substr
+        """
+        lengths = [length for length in (16, 32, 64, 128) if length < cls.MAX_HOST_LENGTH] + [cls.MAX_HOST_LENGTH]
+        reversed_sql = ['WHEN length({0}) <= {1:d} THEN {2}'
+                        .format(host, length, ' || '.join('substr({0}, {1:d}, 1)'.format(host, position)
+                                                          for position in range(length, 0, -1)))
+                        for length in lengths]
+        return 'CASE {0} END || \'.\''.format(' '.join(reversed_sql))
+
+    @staticmethod
+    def _get_indexed_host(host):
+        """
+        :return: string: host as stored in tccleaner_host, reversed with a trailing dot, 'moc.niamod.'
+        """
+        return host[::-1] + '.'
+
+    @staticmethod
+    def _get_host_sql(url):
+        """
+        :return: string: sql expression of the normalized host of url using only built-in functions,
+            the lower case host name without scheme, user info, port and path, as _normalize_host
+        """
+        authority = 'substr({0}, instr({0}, \'://\') + 3)'.format(url)
+        authority = 'substr({0}, 1, instr({0} || \'/\', \'/\') - 1)'.format(authority)
+        host = 'substr({0}, instr({0}, \'@\') + 1)'.format(authority)
+        host = 'substr({0}, 1, instr({0} || \':\', \':\') - 1)'.format(host)
+        return 'lower({0})'.format(host)
+
+    @staticmethod
+    def _normalize_host(host):
+        """
+        :return: string: the lower case host name of host or of a url, as stored in tccleaner_host
+        """
+        if '://' in host:
+            host = host.split('://', 1)[1]
+        host = host.split('/', 1)[0]
+        host = host.split('@', 1)[-1]
+        host = host.split(':', 1)[0]
+        return host.lower()
+
+    def _get_file_size(self, cachedurl):
+        try:
+            return os.path.getsize(os.path.join(self.THUMBNAILS, cachedurl))
+        except OSError:
+            return 0
+
+    def _connect(self, timeout=5.0):
+        """
+        :param timeout: float: seconds to wait for a lock held by another connection (Kodi) before failing
+        :return: sqlite3.Connection: connection to the database in autocommit mode with the REGEXP operator available
+        """
+        connection = sqlite3.connect(self.DATABASE, timeout=timeout)
+        connection.isolation_level = None
+
+        compiled = dict()
+
+        def regexp(pattern, value):
+            # sqlite calls regexp(pattern, value) for 'value REGEXP pattern', pattern is a json list of regexes
+            # from _get_match_clause, each compiled once and matched separately
+            if pattern not in compiled:
+                compiled[pattern] = self._compile_regexes(json.loads(pattern))
+            return value is not None and any(regex.search(value) for regex in compiled[pattern])
+
+        connection.create_function('regexp', 2, regexp)
+        return connection
+
+    @classmethod
+    def _get_match_clause(cls, patterns=None, regexes=None):
+        """
+        :return: tuple: (sql condition on texture.url matching any of the patterns or regexes, parameters)
+        :raises ValueError: if one of the regexes is not a valid regular expression
+        """
+        conditions = ['url LIKE ?' for _ in patterns or []]
+        parameters = list(patterns or [])
+        if regexes:
+            # validate before any transaction is opened, a single REGEXP call per row tests all of them
+            cls._compile_regexes(regexes)
+            conditions.append('url REGEXP ?')
+            parameters.append(json.dumps(list(regexes)))
+        return ' OR '.join(conditions), tuple(parameters)
+
+    @staticmethod
+    def _compile_regexes(regexes):
+        """
+        :return: list: compiled regexes
+        :raises ValueError: if one of the regexes is not a valid regular expression
+        """
+        compiled = list()
+        for regex in regexes:
+            try:
+                compiled.append(re.compile(regex))
+            except re.error as error:
+                raise ValueError('Invalid regular expression |{0}|: {1}'.format(regex, error))
+        return compiled
+
+    def get_free_page_stats(self, cursor=None):
+        """
+        Free page statistics of the database, to decide whether it is worth compacting
+        :param cursor: sqlite3.Cursor: cursor of an open connection to the database, one is opened if None
+        :return: dict: page_size, page_count, freelist_count, free_bytes, free_ratio and auto_vacuum mode,
+            None if there is no database
+        """
+        connection = None
+        if cursor is None:
+            if not xbmcvfs.exists(self.DATABASE):
+                return None
+            connection = self._connect()
+            cursor = connection.cursor()
+        try:
+            page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+            page_count = cursor.execute('PRAGMA page_count').fetchone()[0]
+            freelist_count = cursor.execute('PRAGMA freelist_count').fetchone()[0]
+            auto_vacuum = cursor.execute('PRAGMA auto_vacuum').fetchone()[0]
+        finally:
+            if connection:
+                cursor.close()
+                connection.close()
+        return {
+            'page_size': page_size,
+            'page_count': page_count,
+            'freelist_count': freelist_count,
+            'free_bytes': page_size * freelist_count,
+            'free_ratio': float(freelist_count) / page_count if page_count else 0.0,
+            'auto_vacuum': self.AUTO_VACUUM_MODES.get(auto_vacuum, auto_vacuum),
+        }
+
+    def compact(self, cursor, vacuum=None):
+        """
+        Recovers free space according to the vacuum policy, must be called outside of a transaction
+        :param cursor: sqlite3.Cursor: cursor of an open connection to the database
+        :param vacuum: string: vacuum policy used instead of the instance's, None for the instance's
+        :return: dict: free page statistics after compacting, see get_free_page_stats
+        """
+        vacuum = vacuum or self.vacuum
+        stats = self.get_free_page_stats(cursor)
+        xbmc.log('{0}: {1} free pages ({2:.1%}) before compacting with vacuum policy |{3}|'
+                 .format(self.NAME, stats['freelist_count'], stats['free_ratio'], vacuum), xbmc.LOGDEBUG)
+
+        if vacuum == self.VACUUM_ALWAYS:
+            cursor.execute('VACUUM')
+        elif vacuum == self.VACUUM_THRESHOLD:
+            if stats['freelist_count'] and stats['free_ratio'] >= self.free_page_threshold:
+                cursor.execute('VACUUM')
+        elif vacuum == self.VACUUM_INCREMENTAL:
+            if stats['auto_vacuum'] != 'incremental':
+                # auto_vacuum can only be changed by a full vacuum, after it free pages are kept in the database
+                cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                cursor.execute('VACUUM')
+            elif stats['freelist_count']:
+                # each step of the pragma frees one page, executescript steps it to completion
+                cursor.executescript('PRAGMA incremental_vacuum({0:d});'.format(int(self.incremental_pages)))
+        else:
+            return stats
+
+        return self.get_free_page_stats(cursor)
+
+    def delete_thumbnails(self, thumbnails, progress=None):
+        """
+        Deletes cached images on a bounded pool of threads
+        :param thumbnails: list: paths of the cached images to be deleted
+        :param progress: callable: called with (percent, completed count), at most every PROGRESS_INTERVAL seconds
+        :return: tuple: (deleted count, list of paths that could not be deleted)
+        """
+        paths = queue.Queue()
+        for thumbnail in thumbnails:
+            paths.put(thumbnail)
+
+        lock = threading.Lock()
+        results = {'completed': 0, 'deleted': 0, 'failed': list()}
+
+        def worker():
+            while True:
+                try:
+                    path = paths.get_nowait()
+                except queue.Empty:
+                    return
+                deleted = self._delete_file(path)
+                with lock:
+                    results['completed'] += 1
+                    if deleted:
+                        results['deleted'] += 1
+                    elif deleted is not None:
+                        results['failed'].append(path)
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.DELETE_THREADS, len(thumbnails)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        last_percent = -1
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(self.PROGRESS_INTERVAL)
+                percent = int(results['completed'] * 100 / max(len(thumbnails), 1))
+                if progress and percent != last_percent:
+                    last_percent = percent
+                    progress(percent, results['completed'])
+        if progress and last_percent != 100:
+            progress(100, results['completed'])
+
+        failed = results['failed']
+        if failed:
+            message = 'Failed to delete {0} of {1} cached images: |{2}|{3}' \
+                .format(len(failed), len(thumbnails), '|, |'.join(failed[:10]), ' ...' if len(failed) > 10 else '')
+            xbmc.log(message, xbmc.LOGERROR)
+        return results['deleted'], failed
+
+    @staticmethod
+    def _delete_file(path):
+        """
+        :return: True if deleted, False if it could not be deleted, None if it did not exist
+        """
+        if not xbmcvfs.exists(path):
+            return None
+        try:
+            if xbmcvfs.delete(path):
+                return True
+        except:
+            pass
+        try:
+            os.remove(path)
+        except:
+            return not os.path.exists(path)
+        return True
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmark for tccleaner.py
+
+    Builds a synthetic Textures13.db, with the texture and sizes tables, indexes and trigger
+    Kodi creates, and a matching special://thumbnails/ tree, then times each purge path of
+    TextureCacheCleaner on a fresh copy of it. xbmc, xbmcvfs, xbmcgui and xbmcaddon are
+    replaced by local stubs, so it runs outside of Kodi.
+    Results are saved as JSON and can be compared with a previous run.
+
+    Python 2.7 -> 3.x, runs offline
+
+    usage:
+        python tccleaner_benchmark.py --rows 100000 --hosts 20 --image-size 4096 --output results.json
+        python tccleaner_benchmark.py --rows 1000000 --image-size 0 --scenarios remove_like,report_like
+        python tccleaner_benchmark.py --rows 1000000 --image-size 0 --scenarios reconcile --output reconcile.json
+        python tccleaner_benchmark.py --compare results.json
+
+    Copyright (C) 2016 anxdpanic
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+
+__script__ = 'tccleaner_benchmark.py'
+
+TIMER = getattr(time, 'perf_counter', time.time)
+
+SCHEMA = '''
+CREATE TABLE version (idVersion integer, iCompressCount integer);
+CREATE TABLE texture (id integer primary key, url text, cachedurl text, imagehash text, lasthashcheck text);
+CREATE INDEX idxTexture ON texture(url);
+CREATE TABLE sizes (idtexture integer, size integer, width integer, height integer, usecount integer,
+                    lastusetime text);
+CREATE INDEX idxSize ON sizes(idtexture, size);
+CREATE INDEX idxSize2 ON sizes(idtexture, width, height);
+CREATE TRIGGER textureDelete AFTER delete ON texture FOR EACH ROW BEGIN
+    delete from sizes where sizes.idtexture=old.id;
+END;
+INSERT INTO version (idVersion, iCompressCount) VALUES (13, 0);
+'''
+
+SCENARIOS = ['report_like', 'remove_like', 'remove_matching', 'trim', 'reconcile', 'purge_in_background',
+             'build_host_index', 'remove_host', 'remove_prefix']
+
+
+def install_kodi_stubs(home):
+    # minimal xbmc, xbmcvfs, xbmcgui and xbmcaddon modules, special:// paths are mapped into home
+    xbmc = types.ModuleType('xbmc')
+    xbmc.LOGDEBUG, xbmc.LOGINFO, xbmc.LOGNOTICE, xbmc.LOGWARNING, xbmc.LOGERROR = range(5)
+
+    def translate_path(path):
+        if path.startswith('special://'):
+            return os.path.join(home, *path[len('special://'):].split('/'))
+        return path
+
+    class Monitor(object):
+        def abortRequested(self):
+            return False
+
+        def waitForAbort(self, timeout=0):
+            if timeout:
+                time.sleep(timeout)
+            return False
+
+    xbmc.translatePath = translate_path
+    xbmc.log = lambda message, level=xbmc.LOGDEBUG: None
+    xbmc.Monitor = Monitor
+
+    xbmcvfs = types.ModuleType('xbmcvfs')
+    xbmcvfs.exists = os.path.exists
+
+    def delete(path):
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
+
+    xbmcvfs.delete = delete
+
+    class Dialog(object):
+        def notification(self, *args, **kwargs):
+            pass
+
+    class DialogProgressBG(object):
+        def create(self, heading, message=''):
+            pass
+
+        def update(self, percent=0, heading=None, message=None):
+            pass
+
+        def close(self):
+            pass
+
+    xbmcgui = types.ModuleType('xbmcgui')
+    xbmcgui.Dialog = Dialog
+    xbmcgui.DialogProgressBG = DialogProgressBG
+
+    class Addon(object):
+        def __init__(self, addon_id=None):
+            self.addon_id = addon_id or 'script.module.tccleaner.benchmark'
+
+        def getAddonInfo(self, key):
+            return {
+                'id': self.addon_id,
+                'name': 'TextureCacheCleaner Benchmark',
+                'profile': 'special://profile/addon_data/%s/' % self.addon_id,
+            }.get(key, '')
+
+    xbmcaddon = types.ModuleType('xbmcaddon')
+    xbmcaddon.Addon = Addon
+
+    for module in (xbmc, xbmcvfs, xbmcgui, xbmcaddon):
+        sys.modules[module.__name__] = module
+
+
+def load_tccleaner(path):
+    # load tccleaner.py after the stubs are installed, its class attributes translate special:// paths
+    if sys.version_info >= (3, 5):
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('tccleaner', path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['tccleaner'] = module
+        spec.loader.exec_module(module)
+    else:
+        import imp
+        module = imp.load_source('tccleaner', path)
+    return module
+
+
+def get_host(index):
+    return 'img%d.host%d.example.com' % (index % 3, index)
+
+
+def generate_cache(path, args):
+    # a Textures13.db and thumbnails tree like Kodi's, urls are spread over args.hosts hosts
+    database_path = os.path.join(path, 'database')
+    thumbnails_path = os.path.join(path, 'thumbnails')
+    os.makedirs(database_path)
+    for folder in '0123456789abcdef':
+        os.makedirs(os.path.join(thumbnails_path, folder))
+
+    rng = random.Random(args.seed)
+    image = b'\xff\xd8' + b'\0' * max(args.image_size - 2, 0) if args.image_size else b''
+    connection = sqlite3.connect(os.path.join(database_path, 'Textures13.db'))
+    connection.executescript(SCHEMA)
+    textures = []
+    sizes = []
+    for texture_id in range(1, args.rows + 1):
+        url = 'http://%s/images/%d/%s.jpg' % (get_host(rng.randrange(args.hosts)), texture_id // 1000,
+                                               rng.getrandbits(64))
+        image_hash = hashlib.md5(url.encode('utf-8')).hexdigest()[:8]
+        cachedurl = '%s/%s.jpg' % (image_hash[0], image_hash)
+        textures.append((texture_id, url, cachedurl, '', '2020-01-01 00:00:00'))
+        sizes.append((texture_id, 1, 512, 288, rng.randint(1, 100),
+                      '2020-%02d-%02d %02d:00:00' % (rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23))))
+        with open(os.path.join(thumbnails_path, image_hash[0], image_hash + '.jpg'), 'wb') as open_file:
+            open_file.write(image)
+        if len(textures) >= 10000:
+            connection.executemany('INSERT INTO texture VALUES (?, ?, ?, ?, ?)', textures)
+            connection.executemany('INSERT INTO sizes VALUES (?, ?, ?, ?, ?, ?)', sizes)
+            textures = []
+            sizes = []
+    connection.executemany('INSERT INTO texture VALUES (?, ?, ?, ?, ?)', textures)
+    connection.executemany('INSERT INTO sizes VALUES (?, ?, ?, ?, ?, ?)', sizes)
+    connection.commit()
+    connection.close()
+
+
+def reset_cache(template, home):
+    for folder in ('database', 'thumbnails', 'profile'):
+        shutil.rmtree(os.path.join(home, folder), ignore_errors=True)
+    shutil.copytree(os.path.join(template, 'database'), os.path.join(home, 'database'))
+    shutil.copytree(os.path.join(template, 'thumbnails'), os.path.join(home, 'thumbnails'))
+
+
+def prepare_scenario(module, scenario, args):
+    # untimed setup, remove_host is timed with its index in place as it is after the first purge
+    if scenario == 'remove_host':
+        module.TextureCacheCleaner().build_host_index()
+
+
+def run_scenario(module, scenario, args):
+    # returns the result of the purge path, patterns match the urls of the first host or hosts
+    cleaner = module.TextureCacheCleaner(vacuum=args.vacuum)
+    pattern = 'http://%s/%%' % get_host(0)
+    if scenario == 'report_like':
+        return cleaner.report_like(pattern)
+    if scenario == 'remove_like':
+        return cleaner.remove_like(pattern, notify=False)
+    if scenario == 'remove_matching':
+        return cleaner.remove_matching(patterns=[pattern, 'http://%s/%%' % get_host(1)],
+                                       regexes=[r'^http://img\d\.host2\.example\.com/'], notify=False)
+    if scenario == 'trim':
+        return cleaner.trim(max_entries=args.rows // 2, policy='lru', notify=False)
+    if scenario == 'reconcile':
+        return cleaner.reconcile(notify=False)
+    if scenario == 'purge_in_background':
+        return cleaner.purge_in_background(patterns=[pattern], pause=0)
+    if scenario == 'build_host_index':
+        return cleaner.build_host_index()
+    if scenario == 'remove_host':
+        return cleaner.remove_host(get_host(0), notify=False)
+    if scenario == 'remove_prefix':
+        return cleaner.remove_prefix(pattern[:-1], notify=False)
+    raise ValueError('Unknown scenario %s' % scenario)
+
+
+def benchmark(args):
+    root = tempfile.mkdtemp(prefix='tccleaner_benchmark_')
+    template = os.path.join(root, 'template')
+    home = os.path.join(root, 'home')
+    install_kodi_stubs(home)
+    module = load_tccleaner(args.module)
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sqlite': sqlite3.sqlite_version,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': dict((key, value) for key, value in vars(args).items()
+                           if key not in ('output', 'compare', 'keep')),
+        'runs': [],
+    }
+
+    try:
+        started = TIMER()
+        generate_cache(template, args)
+        results['generation'] = TIMER() - started
+        print('Generated %d textures in %.2fs' % (args.rows, results['generation']))
+
+        for repeat in range(args.repeat):
+            for scenario in args.scenarios:
+                reset_cache(template, home)
+                prepare_scenario(module, scenario, args)
+                started = TIMER()
+                result = run_scenario(module, scenario, args)
+                run = {
+                    'scenario': scenario,
+                    'repeat': repeat,
+                    'total': TIMER() - started,
+                    'result': result,
+                    'database_bytes': os.path.getsize(os.path.join(home, 'database', 'Textures13.db')),
+                }
+                results['runs'].append(run)
+                print_run(run)
+    finally:
+        if args.keep:
+            print('Kept synthetic cache in %s' % root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return results
+
+
+def summarize(results):
+    # best time of every scenario over all repeats
+    summary = {}
+    for run in results['runs']:
+        best = summary.get(run['scenario'])
+        if best is None or run['total'] < best['total']:
+            summary[run['scenario']] = run
+    return summary
+
+
+def print_run(run):
+    result = run['result']
+    if isinstance(result, dict):
+        result = ', '.join('%s %s' % (key, value) for key, value in sorted(result.items()) if key != 'sample')
+    print('%-20s %8.3fs  |  %s' % (run['scenario'], run['total'], result))
+
+
+def print_comparison(previous, current):
+    previous_summary = summarize(previous)
+    current_summary = summarize(current)
+    print(' ')
+    print('Compared with %s:' % previous.get('timestamp'))
+    for scenario in SCENARIOS:
+        if scenario not in previous_summary or scenario not in current_summary:
+            continue
+        before = previous_summary[scenario]['total']
+        after = current_summary[scenario]['total']
+        change = ((after - before) / before * 100.0) if before else 0.0
+        print('%-20s %.3fs -> %.3fs  (%+.1f%%)' % (scenario, before, after, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=__script__)
+    parser.add_argument('--module', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tccleaner.py'),
+                        help='path to the tccleaner.py to benchmark')
+    parser.add_argument('--rows', type=int, default=10000, help='number of cached textures')
+    parser.add_argument('--hosts', type=int, default=10, help='number of hosts the urls are spread over')
+    parser.add_argument('--image-size', type=int, default=2048, help='size of each cached image, 0 for empty files')
+    parser.add_argument('--vacuum', default='threshold', help='vacuum policy of the TextureCacheCleaner')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated purge paths to time, of: %s' % ', '.join(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=1, help='number of repetitions')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated urls and usage')
+    parser.add_argument('--output', default='tccleaner_benchmark.json', help='file to save the results to')
+    parser.add_argument('--compare', default='', help='previous results to compare with')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic cache for inspection')
+    args = parser.parse_args()
+    args.scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+
+    results = benchmark(args)
+
+    with open(args.output, 'w') as open_file:
+        json.dump(results, open_file, indent=2, sort_keys=True)
+    print(' ')
+    print('Results saved to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare, 'r') as open_file:
+            print_comparison(json.load(open_file), results)
+
+
+if __name__ == '__main__':
+    main()
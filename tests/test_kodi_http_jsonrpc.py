@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for kodi_http_jsonrpc.py, run outside of Kodi with the stubs of tccleaner_benchmark.py
+
+    usage:
+        python -m unittest discover tests
+"""
+
+import errno
+import json
+import os
+import socket
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+    sys.modules['httplib'] = httplib
+
+if 'xbmc' not in sys.modules:
+    import tccleaner_benchmark  # noqa: E402
+    tccleaner_benchmark.install_kodi_stubs(tempfile.gettempdir())
+
+import kodi_http_jsonrpc  # noqa: E402
+
+
+class Response(object):
+    status = 200
+    reason = 'OK'
+    will_close = False
+
+    def __init__(self, contents=None, error=None):
+        self.contents = contents
+        self.error = error
+
+    def read(self):
+        if self.error:
+            raise self.error
+        return self.contents
+
+
+class Connection(object):
+    def __init__(self, request_error=None, response_error=None, response=None):
+        self.request_error = request_error
+        self.response_error = response_error
+        self.response = response
+        self.requests = 0
+        self.closed = False
+
+    def request(self, method, url, body=None, headers=None):
+        self.requests += 1
+        if self.request_error:
+            raise self.request_error
+
+    def getresponse(self):
+        if self.response_error:
+            raise self.response_error
+        return self.response
+
+    def close(self):
+        self.closed = True
+
+
+class Pool(object):
+    # hands out the reused connection first, then fresh ones
+    def __init__(self, reused, fresh):
+        self.connections = [(reused, True), (fresh, False)]
+        self.released = []
+
+    def acquire(self, host, port):
+        return self.connections.pop(0)
+
+    def release(self, host, port, connection):
+        self.released.append(connection)
+
+
+def get_result():
+    return Response(json.dumps({'jsonrpc': '2.0', 'id': 1, 'result': 'OK'}))
+
+
+class HttpJSONRPCTestCase(unittest.TestCase):
+    command = {'jsonrpc': '2.0', 'id': 1, 'method': 'Player.Stop', 'params': {'playerid': 1}}
+
+    def execute(self, reused):
+        fresh = Connection(response=get_result())
+        pool = Pool(reused, fresh)
+        client = kodi_http_jsonrpc.HttpJSONRPC(ip_address='127.0.0.1', port='8080', username=b'kodi',
+                                               password=b'kodi', pool=pool)
+        return client.execute_rpc(self.command), fresh
+
+    def test_closed_idle_connection_is_retried(self):
+        reused = Connection(response_error=httplib.BadStatusLine(''))
+        response, fresh = self.execute(reused)
+        self.assertEqual(response, {'result': 'OK'})
+        self.assertTrue(reused.closed)
+        self.assertEqual(fresh.requests, 1)
+
+    def test_reset_while_sending_is_retried(self):
+        reused = Connection(request_error=socket.error(errno.EPIPE, 'Broken pipe'))
+        response, fresh = self.execute(reused)
+        self.assertEqual(response, {'result': 'OK'})
+        self.assertEqual(fresh.requests, 1)
+
+    def test_failure_mid_response_is_not_retried(self):
+        reused = Connection(response=Response(error=socket.error(errno.ECONNRESET, 'Connection reset by peer')))
+        response, fresh = self.execute(reused)
+        self.assertIn('error', response)
+        self.assertEqual(reused.requests, 1)
+        self.assertTrue(reused.closed)
+        self.assertEqual(fresh.requests, 0)
+
+    def test_incomplete_response_is_not_retried(self):
+        reused = Connection(response=Response(error=httplib.IncompleteRead(b'{"jsonrpc"')))
+        response, fresh = self.execute(reused)
+        self.assertIn('error', response)
+        self.assertEqual(fresh.requests, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
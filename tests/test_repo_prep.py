@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for repo_prep/.repo_prep.py, needs lxml like .repo_prep.py
+
+    usage:
+        python -m unittest discover tests
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_PREP = os.path.join(ROOT, 'repo_prep', '.repo_prep.py')
+
+
+def load_repo_prep(path):
+    # load .repo_prep.py as a module named repo_prep, as .repo_prep_benchmark.py does
+    if sys.version_info >= (3, 5):
+        import importlib.util  # pylint: disable=import-outside-toplevel
+        spec = importlib.util.spec_from_file_location('repo_prep', path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['repo_prep'] = module
+        spec.loader.exec_module(module)
+    else:
+        import imp  # pylint: disable=import-outside-toplevel
+        module = imp.load_source('repo_prep', path)
+    return module
+
+
+repo_prep = load_repo_prep(REPO_PREP)
+
+ADDON_XML = u'''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<addon id="%(addon_id)s" name="Test" version="%(version)s" provider-name="tests">
+  <requires>
+    <import addon="xbmc.python" version="3.0.0"/>
+  </requires>
+  <extension point="xbmc.python.pluginsource" library="default.py">
+    <provides>video</provides>
+  </extension>
+  <extension point="xbmc.addon.metadata">
+    <summary lang="en_GB">Test add-on</summary>
+  </extension>
+</addon>
+'''
+
+
+def write_file(filename, contents):
+    folder = os.path.dirname(filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(filename, 'wb') as open_file:
+        open_file.write(contents.encode('utf-8'))
+
+
+class Silenced:
+    # repo_prep prints its progress
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def get_config(root, **settings):
+    with open(os.path.join(ROOT, 'repo_prep', '.config.json'), 'r') as open_file:
+        config = json.load(open_file)
+    config.update({
+        'compress_addons': True,
+        'workers': 1,
+        'matrix_build_version': False,
+        'path': {
+            'source': os.path.join(root, 'source'),
+            'repository': os.path.join(root, 'repository'),
+            'zips': os.path.join(root, 'repository', 'zips'),
+        },
+    })
+    config.update(settings)
+    return config
+
+
+class IgnoreMatcherTestCase(unittest.TestCase):
+    def get_matcher(self, *patterns):
+        return repo_prep.IgnoreMatcher({'patterns': list(patterns)})
+
+    def test_negation(self):
+        matcher = self.get_matcher('*.log', '!keep.log')
+        self.assertTrue(matcher.ignores_path('debug.log'))
+        self.assertTrue(matcher.ignores_path('resources/debug.log'))
+        self.assertFalse(matcher.ignores_path('keep.log'))
+        self.assertFalse(matcher.ignores_path('resources/keep.log'))
+
+    def test_negation_is_ordered(self):
+        # a later pattern ignores the file again
+        matcher = self.get_matcher('*.log', '!keep.log', 'resources/*.log')
+        self.assertFalse(matcher.ignores_path('keep.log'))
+        self.assertTrue(matcher.ignores_path('resources/keep.log'))
+
+    def test_anchored_directory(self):
+        matcher = self.get_matcher('/docs/')
+        self.assertTrue(matcher.ignores_path('docs/index.md'))
+        self.assertTrue(matcher.ignores_path('docs/api/index.md'))
+        self.assertFalse(matcher.ignores_path('sub/docs/index.md'))
+        # directory only, a file named docs is kept
+        self.assertFalse(matcher.ignores_path('docs'))
+
+    def test_unanchored_directory(self):
+        # only a leading or middle '/' anchors a pattern
+        for matcher in (self.get_matcher('docs/'), repo_prep.IgnoreMatcher({'directories': ['docs']})):
+            self.assertTrue(matcher.ignores_path('docs/index.md'))
+            self.assertTrue(matcher.ignores_path('sub/docs/index.md'))
+        matcher = self.get_matcher('sub/docs/')
+        self.assertTrue(matcher.ignores_path('sub/docs/index.md'))
+        self.assertFalse(matcher.ignores_path('resources/sub/docs/index.md'))
+
+    def test_double_star(self):
+        matcher = self.get_matcher('**/cache/**')
+        self.assertTrue(matcher.ignores_path('cache/image.png'))
+        self.assertTrue(matcher.ignores_path('resources/lib/cache/image.png'))
+        self.assertTrue(matcher.ignores_path('resources/cache/thumbs/image.png'))
+        self.assertFalse(matcher.ignores_path('resources/cache.py'))
+        self.assertFalse(matcher.ignores_path('resources/caches/image.png'))
+
+    def test_single_star_and_question_mark_stop_at_slash(self):
+        matcher = self.get_matcher('resources/*.txt', 'tmp?')
+        self.assertTrue(matcher.ignores_path('resources/notes.txt'))
+        self.assertFalse(matcher.ignores_path('resources/lib/notes.txt'))
+        self.assertTrue(matcher.ignores_path('lib/tmp1'))
+        self.assertFalse(matcher.ignores_path('lib/tmp12'))
+
+    def test_negated_character_class(self):
+        matcher = self.get_matcher('[!x]y.txt')
+        self.assertTrue(matcher.ignores_path('ay.txt'))
+        self.assertTrue(matcher.ignores_path('resources/by.txt'))
+        self.assertFalse(matcher.ignores_path('xy.txt'))
+        self.assertFalse(matcher.ignores_path('y.txt'))
+
+    def test_walk_prunes_ignored_directories(self):
+        root = tempfile.mkdtemp(prefix='repo_prep_tests_')
+        try:
+            for relative_path in ('addon.xml', 'debug.log', 'keep.log', 'docs/index.md',
+                                  'resources/docs/index.md', 'resources/cache/a.png', '.git/config'):
+                write_file(os.path.join(root, *relative_path.split('/')), u'')
+            matcher = repo_prep.IgnoreMatcher({'directories': ['.git'],
+                                               'patterns': ['/docs/', '**/cache/**', '*.log', '!keep.log']})
+            walked = [relative_root + name for _, relative_root, files in matcher.walk(root) for name in files]
+            self.assertEqual(sorted(walked), ['addon.xml', 'keep.log', 'resources/docs/index.md'])
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+class RetentionPolicyTestCase(unittest.TestCase):
+    releases = {
+        'plugin.test-1.0.0.zip': {'version': '1.0.0', 'built': time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, -1))},
+        'plugin.test-1.1.0.zip': {'version': '1.1.0', 'built': time.mktime((2021, 1, 1, 0, 0, 0, 0, 0, -1))},
+        'plugin.test-1.2.0.zip': {'version': '1.2.0', 'built': time.mktime((2022, 1, 1, 0, 0, 0, 0, 0, -1))},
+        'plugin.test-1.3.0.zip': {'version': '1.3.0', 'built': time.mktime((2023, 1, 1, 0, 0, 0, 0, 0, -1))},
+    }
+
+    def get_expired(self, retention, current='plugin.test-1.3.0.zip'):
+        return sorted(repo_prep.RetentionPolicy(retention).get_expired(self.releases, current))
+
+    def test_disabled(self):
+        self.assertEqual(self.get_expired({}), [])
+        self.assertEqual(self.get_expired({'keep_versions': 0, 'keep_newer_than': ''}), [])
+
+    def test_keep_versions(self):
+        self.assertEqual(self.get_expired({'keep_versions': 2}),
+                         ['plugin.test-1.0.0.zip', 'plugin.test-1.1.0.zip'])
+
+    def test_current_is_kept(self):
+        # the current release is kept even when it isn't among the newest
+        self.assertEqual(self.get_expired({'keep_versions': 1}, 'plugin.test-1.0.0.zip'),
+                         ['plugin.test-1.1.0.zip', 'plugin.test-1.2.0.zip'])
+
+    def test_keep_newer_than(self):
+        self.assertEqual(self.get_expired({'keep_newer_than': '2021-06-01'}),
+                         ['plugin.test-1.0.0.zip', 'plugin.test-1.1.0.zip'])
+
+    def test_either_keeps(self):
+        self.assertEqual(self.get_expired({'keep_versions': 3, 'keep_newer_than': '2022-06-01'}),
+                         ['plugin.test-1.0.0.zip'])
+        self.assertEqual(self.get_expired({'keep_versions': 1, 'keep_newer_than': '2021-06-01'}),
+                         ['plugin.test-1.0.0.zip', 'plugin.test-1.1.0.zip'])
+
+
+class RepoPrepTestCase(unittest.TestCase):
+    addon_id = 'plugin.video.test'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='repo_prep_tests_')
+        self.source = os.path.join(self.root, 'source', self.addon_id)
+        self.zips = os.path.join(self.root, 'repository', 'zips')
+        os.makedirs(self.zips)
+        write_file(os.path.join(self.source, 'addon.xml'), ADDON_XML % {'addon_id': self.addon_id,
+                                                                       'version': '1.0.0'})
+        write_file(os.path.join(self.source, 'default.py'), u'import xbmc\n')
+        write_file(os.path.join(self.source, 'resources', 'lib', 'module.py'), u'value = 1\n')
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def build(self):
+        # returns the add-ons recursive_zipper compressed
+        zipped = []
+        recursive_zipper = repo_prep.Compressor.recursive_zipper
+
+        def counting_zipper(compressor, directory, zip_file, include_addon_xml=True):
+            zipped.append(compressor.addon_name)
+            return recursive_zipper(compressor, directory, zip_file, include_addon_xml)
+
+        repo_prep.Compressor.recursive_zipper = counting_zipper
+        try:
+            with Silenced():
+                repo_prep.build()
+        finally:
+            repo_prep.Compressor.recursive_zipper = recursive_zipper
+        return zipped
+
+
+class BuildManifestTestCase(RepoPrepTestCase):
+    def test_unchanged_addons_are_skipped(self):
+        repo_prep.load_config(get_config(self.root, build_manifest='.build_manifest.json'))
+        self.assertEqual(self.build(), [self.addon_id])
+        manifest = os.path.join(self.root, 'repository', '.build_manifest.json')
+        self.assertTrue(os.path.exists(manifest))
+        self.assertTrue(os.path.exists(os.path.join(self.zips, self.addon_id, self.addon_id + '-1.0.0.zip')))
+
+        # nothing changed
+        repo_prep.load_config(get_config(self.root, build_manifest='.build_manifest.json'))
+        self.assertEqual(self.build(), [])
+
+        # touched without changing the contents
+        default_py = os.path.join(self.source, 'default.py')
+        os.utime(default_py, (time.time() + 10, time.time() + 10))
+        repo_prep.load_config(get_config(self.root, build_manifest='.build_manifest.json'))
+        self.assertEqual(self.build(), [])
+
+        # changed contents
+        write_file(default_py, u'import xbmcgui\n')
+        repo_prep.load_config(get_config(self.root, build_manifest='.build_manifest.json'))
+        self.assertEqual(self.build(), [self.addon_id])
+
+    def test_force_rebuilds_unchanged_addons(self):
+        repo_prep.load_config(get_config(self.root, build_manifest='.build_manifest.json'))
+        self.assertEqual(self.build(), [self.addon_id])
+        repo_prep.load_config(get_config(self.root, build_manifest='.build_manifest.json', force_rebuild=True))
+        self.assertEqual(self.build(), [self.addon_id])
+
+
+class VerifyZipTestCase(RepoPrepTestCase):
+    def setUp(self):
+        super(VerifyZipTestCase, self).setUp()
+        repo_prep.load_config(get_config(self.root))
+        self.zip_path = os.path.join(self.zips, self.addon_id, self.addon_id + '-1.0.0.zip')
+        os.makedirs(os.path.dirname(self.zip_path))
+
+    def write_zip(self, files):
+        with zipfile.ZipFile(self.zip_path, 'w', compression=zipfile.ZIP_STORED) as zipped_file:
+            zipped_file.writestr(self.addon_id + '/addon.xml',
+                                 ADDON_XML % {'addon_id': self.addon_id, 'version': '1.0.0'})
+            for name, contents in files:
+                zipped_file.writestr(self.addon_id + '/' + name, contents)
+
+    def test_valid_zip(self):
+        self.write_zip([('default.py', 'import xbmc\n')])
+        path, addon_id, version, problems = repo_prep.verify_zip(self.zip_path)
+        self.assertEqual((path, addon_id, version, problems), (self.zip_path, self.addon_id, '1.0.0', []))
+
+    def test_bad_crc(self):
+        self.write_zip([('default.py', 'import xbmc # original contents\n')])
+        with open(self.zip_path, 'rb') as open_file:
+            contents = open_file.read()
+        contents = contents.replace(b'original contents', b'modified contents')
+        with open(self.zip_path, 'wb') as open_file:
+            open_file.write(contents)
+
+        _, _, _, problems = repo_prep.verify_zip(self.zip_path)
+        self.assertEqual(len(problems), 1)
+        self.assertIn('CRC', problems[0])
+
+    def test_ignored_file(self):
+        self.write_zip([('default.py', 'import xbmc\n'), ('resources/lib/module.pyc', ''),
+                        ('.git/config', '')])
+        _, _, _, problems = repo_prep.verify_zip(self.zip_path)
+        self.assertEqual(sorted(problems), ['contains ignored file %s/.git/config' % self.addon_id,
+                                            'contains ignored file %s/resources/lib/module.pyc' % self.addon_id])
+
+    def test_wrong_version(self):
+        self.write_zip([])
+        renamed = self.zip_path.replace('1.0.0', '1.0.1')
+        os.rename(self.zip_path, renamed)
+        _, _, _, problems = repo_prep.verify_zip(renamed)
+        self.assertEqual(problems, ['addon.xml has version 1.0.0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tccleaner.py, run outside of Kodi with the stubs of tccleaner_benchmark.py
+
+    usage:
+        python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import tccleaner_benchmark  # noqa: E402
+
+HOME = tempfile.mkdtemp(prefix='tccleaner_tests_')
+tccleaner_benchmark.install_kodi_stubs(HOME)
+tccleaner = tccleaner_benchmark.load_tccleaner(os.path.join(ROOT, 'tccleaner.py'))
+
+URLS = [
+    'http://a.example.com/a/a.jpg',
+    'http://b.example.com/b/c.jpg',
+    'http://C.EXAMPLE.COM/c.jpg',
+    'http://d.example.com/d.jpg',
+]
+
+
+class TextureCacheCleanerTestCase(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(HOME, ignore_errors=True)
+        os.makedirs(os.path.join(HOME, 'database'))
+        os.makedirs(os.path.join(HOME, 'thumbnails', '0'))
+        connection = sqlite3.connect(tccleaner.TextureCacheCleaner.DATABASE)
+        connection.executescript(tccleaner_benchmark.SCHEMA)
+        for texture_id, url in enumerate(URLS, 1):
+            cachedurl = '0/%d.jpg' % texture_id
+            connection.execute('INSERT INTO texture VALUES (?, ?, ?, \'\', \'\')', (texture_id, url, cachedurl))
+            connection.execute('INSERT INTO sizes VALUES (?, 1, 1, 1, 1, \'\')', (texture_id,))
+            with open(os.path.join(HOME, 'thumbnails', cachedurl), 'wb') as open_file:
+                open_file.write(b'\xff\xd8')
+        connection.commit()
+        connection.close()
+        self.cleaner = tccleaner.TextureCacheCleaner(vacuum=tccleaner.TextureCacheCleaner.VACUUM_NEVER)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(HOME, ignore_errors=True)
+
+    def get_urls(self):
+        connection = sqlite3.connect(self.cleaner.DATABASE)
+        try:
+            return [url for (url,) in connection.execute('SELECT url FROM texture ORDER BY id')]
+        finally:
+            connection.close()
+
+    def test_regex_backreference(self):
+        # the backreference of the second regex refers to its own first group
+        regexes = [r'^http://d\.', r'^http://(\w)\.example\.com/\1/']
+        self.assertEqual(self.cleaner.report_matching(regexes=regexes)['count'], 3)
+        self.assertEqual(self.cleaner.remove_matching(regexes=regexes, notify=False), 3)
+        self.assertEqual(self.get_urls(), [URLS[2]])
+
+    def test_regex_inline_flag(self):
+        regexes = [r'^http://a\.', r'(?i)^http://c\.example\.com/']
+        self.assertEqual(self.cleaner.report_matching(regexes=regexes)['count'], 2)
+        self.assertEqual(self.cleaner.remove_matching(regexes=regexes, notify=False), 2)
+        self.assertEqual(self.get_urls(), [URLS[1], URLS[3]])
+
+    def test_invalid_regex(self):
+        with self.assertRaises(ValueError):
+            self.cleaner.remove_matching(regexes=[r'^http://(a'], notify=False)
+        with self.assertRaises(ValueError):
+            self.cleaner.report_matching(regexes=[r'^http://(a'])
+        self.assertEqual(self.get_urls(), URLS)
+
+    def test_reconcile_in_chunks(self):
+        self.cleaner.RECONCILE_CHUNK_SIZE = 3
+        orphan = os.path.join(HOME, 'thumbnails', '0', '0.jpg')
+        with open(orphan, 'wb') as open_file:
+            open_file.write(b'\xff\xd8')
+        os.utime(orphan, (0, 0))
+        os.remove(os.path.join(HOME, 'thumbnails', '0', '4.jpg'))
+
+        result = self.cleaner.reconcile(notify=False)
+        self.assertEqual((result['orphaned_files'], result['missing_files']), (1, 1))
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(self.get_urls(), URLS[:3])
+
+    def test_reconcile_reads_hold_no_lock(self):
+        self.cleaner.RECONCILE_CHUNK_SIZE = 2
+        writer = sqlite3.connect(self.cleaner.DATABASE, timeout=0)
+
+        class Connection(object):
+            # Kodi writes after the first chunk is copied
+            def __init__(self, connection):
+                self.connection = connection
+                self.chunks = 0
+
+            def execute(self, sql, parameters=()):
+                cursor = self.connection.execute(sql, parameters)
+                if sql.startswith('INSERT INTO temp.reconcile'):
+                    self.chunks += 1
+                    if self.chunks == 1:
+                        writer.execute('INSERT INTO texture VALUES (5, \'http://e.example.com/e.jpg\', '
+                                       '\'0/5.jpg\', \'\', \'\')')
+                        writer.commit()
+                return cursor
+
+        connection = Connection(self.cleaner._connect())
+        try:
+            rows = self.cleaner._read_cachedurls(connection)
+            self.assertEqual(next(rows), (1, '0/1.jpg'))
+            # and while the copy is walked
+            writer.execute('DELETE FROM texture WHERE id = 1')
+            writer.commit()
+            self.assertEqual([cachedurl for _, cachedurl in rows], ['0/2.jpg', '0/3.jpg', '0/4.jpg', '0/5.jpg'])
+            self.assertEqual(connection.chunks, 3)
+        finally:
+            writer.close()
+            connection.connection.close()
+
+    def test_purge_in_background_scans_new_textures(self):
+        database = self.cleaner.DATABASE
+
+        class Monitor(object):
+            # Kodi caches another matching texture while the purge pauses
+            waits = 0
+
+            def waitForAbort(self, timeout=0):
+                self.waits += 1
+                if self.waits == 1:
+                    connection = sqlite3.connect(database)
+                    connection.execute('INSERT INTO texture VALUES (5000, \'http://a.example.com/new.jpg\', '
+                                       '\'0/5000.jpg\', \'\', \'\')')
+                    connection.commit()
+                    connection.close()
+                return False
+
+        result = self.cleaner.purge_in_background(patterns=['http://a.%'], pause=0, monitor=Monitor())
+        self.assertEqual(result, {'removed': 2, 'completed': True})
+        self.assertEqual(self.get_urls(), URLS[1:])
+
+    def test_purge_in_background_reports_progress(self):
+        updates = list()
+        cleaner = tccleaner.TextureCacheCleaner(progress=tccleaner.CallbackProgressReporter(
+            lambda percent, message: updates.append((percent, message)), interval=0))
+        result = cleaner.purge_in_background(patterns=['http://a.%'], pause=0)
+        self.assertEqual(result, {'removed': 1, 'completed': True})
+        self.assertEqual(updates[-1], (100, 'Removed 1 cached items'))
+
+    def test_purge_in_background_stops_on_busy_database(self):
+        class Monitor(object):
+            waits = 0
+
+            def waitForAbort(self, timeout=0):
+                self.waits += 1
+                return False
+
+        self.cleaner.BUSY_RETRIES = 3
+        monitor = Monitor()
+        writer = sqlite3.connect(self.cleaner.DATABASE)
+        try:
+            writer.execute('BEGIN IMMEDIATE')
+            result = self.cleaner.purge_in_background(patterns=['http://a.%'], pause=0, busy_timeout=0,
+                                                      monitor=monitor)
+        finally:
+            writer.rollback()
+            writer.close()
+        self.assertEqual(result, {'removed': 0, 'completed': False})
+        self.assertEqual(monitor.waits, 2)
+
+    def test_purge_in_background_raises_on_readonly_database(self):
+        connect = self.cleaner._connect
+
+        def connect_readonly(timeout=5.0):
+            connection = connect(timeout)
+            connection.execute('PRAGMA query_only = 1')
+            return connection
+
+        self.cleaner._connect = connect_readonly
+        with self.assertRaises(sqlite3.OperationalError):
+            self.cleaner.purge_in_background(patterns=['http://a.%'], pause=0)
+        self.assertEqual(self.get_urls(), URLS)
+
+    def test_purge_in_background_never_runs_full_vacuum(self):
+        connection = sqlite3.connect(self.cleaner.DATABASE)
+        connection.executemany('INSERT INTO texture VALUES (?, ?, \'\', \'\', \'\')',
+                               [(texture_id, 'http://f.example.com/%s.jpg' % ('f' * 500))
+                                for texture_id in range(10, 1010)])
+        connection.commit()
+        connection.close()
+
+        cleaner = tccleaner.TextureCacheCleaner(vacuum=tccleaner.TextureCacheCleaner.VACUUM_ALWAYS)
+        result = cleaner.purge_in_background(patterns=['http://f.%'], pause=0)
+        self.assertEqual(result, {'removed': 1000, 'completed': True})
+        stats = cleaner.get_free_page_stats()
+        self.assertGreater(stats['freelist_count'], 0)
+        self.assertEqual(stats['auto_vacuum'], 'none')
+
+    def test_remove_host(self):
+        self.assertTrue(self.cleaner.build_host_index())
+        connection = sqlite3.connect(self.cleaner.DATABASE)
+        connection.execute('INSERT INTO texture VALUES (5, \'https://user@img.b.example.com:8080/b.jpg\', '
+                           '\'0/5.jpg\', \'\', \'\')')
+        connection.execute('INSERT INTO texture VALUES (6, \'https://xb.example.com/b.jpg\', \'0/6.jpg\', \'\', \'\')')
+        connection.commit()
+        connection.close()
+
+        self.assertEqual(self.cleaner.remove_host('b.example.com', include_subdomains=False, notify=False), 1)
+        self.assertEqual(self.cleaner.remove_host('http://B.example.com/', notify=False), 1)
+        self.assertEqual(self.get_urls(), [URLS[0], URLS[2], URLS[3], 'https://xb.example.com/b.jpg'])
+        self.assertEqual(self.cleaner.remove_host('example.com', notify=False), 4)
+        self.assertEqual(self.get_urls(), [])
+
+    def test_remove_host_range_scan(self):
+        self.cleaner.build_host_index()
+        connection = sqlite3.connect(self.cleaner.DATABASE)
+        try:
+            plan = ' '.join(row[-1] for row in connection.execute(
+                'EXPLAIN QUERY PLAN SELECT idtexture FROM tccleaner_host WHERE host >= ? AND host < ?', ('a.', 'a/')))
+            self.assertIn('idxTCCleanerHost', plan)
+            self.assertEqual(connection.execute('SELECT host FROM tccleaner_host WHERE idtexture = 3').fetchone()[0],
+                             'moc.elpmaxe.c.')
+        finally:
+            connection.close()
+
+    def test_reversed_host_sql(self):
+        connection = sqlite3.connect(':memory:')
+        try:
+            connection.execute('CREATE TABLE hosts (host TEXT)')
+            for length in (1, 16, 17, 100, 253):
+                host = ''.join('abcdefghij.'[position % 11] for position in range(length))
+                connection.execute('DELETE FROM hosts')
+                connection.execute('INSERT INTO hosts VALUES (?)', (host,))
+                reversed_host = connection.execute('SELECT {0} FROM hosts'.format(
+                    self.cleaner._get_reversed_host_sql('host'))).fetchone()[0]
+                self.assertEqual(reversed_host, self.cleaner._get_indexed_host(host))
+        finally:
+            connection.close()
+
+    def test_outdated_host_index_is_rebuilt(self):
+        connection = sqlite3.connect(self.cleaner.DATABASE)
+        connection.executescript('CREATE TABLE tccleaner_host (idtexture INTEGER PRIMARY KEY, host TEXT NOT NULL);'
+                                 'INSERT INTO tccleaner_host VALUES (1, \'a.example.com\');' +
+                                 ''.join('CREATE TRIGGER {0} AFTER DELETE ON texture BEGIN SELECT 1; END;'.format(name)
+                                         for name in self.cleaner.HOST_INDEX_TRIGGERS))
+        connection.close()
+        self.assertTrue(self.cleaner.build_host_index())
+        self.assertFalse(self.cleaner.build_host_index())
+        self.assertEqual(self.cleaner.remove_host('a.example.com', notify=False), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()